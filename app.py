@@ -1,11 +1,26 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory, g, has_request_context
 import sqlite3
 import re
 import os
 import sys
 import time
 import json
-from datetime import datetime, timedelta
+import calendar
+import hashlib
+import codecs
+import gzip
+import threading
+import bisect
+import heapq
+import queue
+import atexit
+import uuid
+import urllib.parse
+import multiprocessing
+import signal
+import functools
+import click
+from datetime import datetime, date, timedelta
 
 app = Flask(__name__)
 # 🔥 新增：开启网页模板热重载，修改 HTML 保存后刷新浏览器立刻生效！
@@ -14,51 +29,103 @@ app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 app.jinja_env.variable_start_string = '[['
 app.jinja_env.variable_end_string = ']]'
 
-DB_PATH = '/app/data/lottery.db'
-ROUND_SETTINGS_FILE = '/app/data/round_settings.json'
+DB_PATH = os.environ.get('DB_PATH', '/app/data/lottery.db')
+ROUND_SETTINGS_FILE = os.environ.get('ROUND_SETTINGS_FILE', '/app/data/round_settings.json')
+CURSOR_PREFIX_BYTES = 4096  # 文件头指纹长度，用于识别日志轮转/截断
+UPLOAD_CURSOR_TTL_SECONDS = 2 * 86400  # 超过这么久没有上传的文件（麒麟/貔貅按天分文件）不再下发游标，并定期删除
+UPLOAD_CHUNK_SIZE = 64 * 1024
+INSERT_BATCH_SIZE = 2000
+ONLINE_WINDOW_SECONDS = 15
+SSE_KEEPALIVE_SECONDS = 15
+PRESENCE_FLUSH_SECONDS = 1  # 心跳状态批量写回 devices 表的间隔（要远小于 ONLINE_WINDOW_SECONDS，其他 worker 才能及时看到）
+PRESENCE_SYNC_SECONDS = 5  # 整表合并其他 worker 写入（模板切换 / 删除节点等）的间隔
+SSE_POLL_SECONDS = 0.5  # 各进程从 events 表拉取推送事件的间隔
+SSE_EVENT_TTL_SECONDS = 300
+SSE_SUBSCRIBER_TTL_SECONDS = 30  # 订阅登记的有效期，各进程的轮询线程定期续期；进程退出后自然过期
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '16'))
+# 入库模式：inline = /upload 同步解析入库；spool = 只落盘排队，返回 202，由解析进程池异步入库
+INGEST_MODE = os.environ.get('INGEST_MODE', 'inline')
+SPOOL_DIR = os.environ.get('SPOOL_DIR', '/app/data/spool')
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', '2'))
+SPOOL_POLL_SECONDS = 0.5
+SPOOL_SUPERVISOR_STALE_SECONDS = 10  # supervisor.json 超过这么久没更新，视为解析进程池没在跑，/upload 改为同步入库
+SPOOL_BATCH_JOBS = 20  # 每个解析进程一次认领、一个事务提交的任务数
+SSE_MAX_DELTA_ROWS = 500  # 单次新增超过这个数就只通知前端整体刷新
+DETAILS_PAGE_SIZE = 200  # 明细分页默认每页行数
+DETAILS_PAGE_MAX = 5000
+DETAILS_LIMIT_STEPS = (0, 50, DETAILS_PAGE_SIZE, 1000, DETAILS_PAGE_MAX)  # /api/stats 的 details_limit 只取这几档
+GZIP_MIN_BYTES = 1024  # 小于这个大小的响应不压缩
+GZIP_MIMETYPES = ('application/json', 'text/html', 'text/plain')
+METRICS_DIR = os.environ.get('METRICS_DIR', '/app/data/metrics')
+METRICS_FLUSH_SECONDS = 10
+METRICS_STALE_SECONDS = 300  # 超过这么久没更新的进程指标文件视为已退出，删除
+# 日志保留天数：>0 时更早的日志按月归档到 ARCHIVE_DIR（0 = 不归档）
+LOG_RETENTION_DAYS = int(os.environ.get('LOG_RETENTION_DAYS', '0'))
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', '/app/data/archive')
+ARCHIVE_INTERVAL_SECONDS = 86400  # 自动归档的运行间隔（多进程共用 archive_state.last_run）
+ARCHIVE_CHECK_SECONDS = 3600
+ARCHIVE_VACUUM_PAGES = 2000  # 后台归档后增量回收空闲页，每步最多回收这么多页（一个短写事务）
+ARCHIVE_MAX_ATTACHED = 8  # 单次查询最多 ATTACH 的归档月份数（SQLite 默认上限 10）
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', '0'))  # >0 时，超过该耗时的请求打印最慢的几条查询及其执行计划
+DETECT_SAMPLE_LINES = 200  # 每次上传取前多少个非空行给所有模板打分，自动识别日志格式
+
+DAY_SECONDS = 86400
 
 MONTH_MAP = {
     'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
     'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
 }
 
-LOG_PARSERS = {
-    "default": {
-        "name": "万花筒 (仅限 lot.txt)",
-        "pattern": r"\[(.*?)\]\s+(.*?)_\d+\s+\|.*?[,，]\s*(?:.*?)[,，]\s*(\d+)",
-        "item_type": "钻石",
-        "file_rule": "lot.txt",  
-        "folder_rule": ""        
-    },
-    "qilin": {
-        "name": "麒麟 (logs 目录多文档)",
-        "pattern": r"\[(.*?)\]\s*恭喜\[(.*?)\].*?中了-(\d+)-",
-        "item_type": "钻石",
-        "file_rule": "*qiling.txt", 
-        "folder_rule": "logs"       
-    },
-    "pixiu": {
-        "name": "貔貅 (含实物动态解析)",
-        "pattern": r"^(.*?)----.*?----.*?----(.*?)----(.*)$",
-        "item_type": "动态",
-        "file_rule": "*中奖记录.txt", 
-        "folder_rule": "中奖记录"       
-    }
-}
-
 def load_round_times():
+    """旧版本的轮次起点存放在 round_settings.json，建 round_settings 表时导入一次"""
     if os.path.exists(ROUND_SETTINGS_FILE):
         try:
             with open(ROUND_SETTINGS_FILE, 'r', encoding='utf-8') as f: return json.load(f)
         except: return {}
     return {}
 
-def save_round_times(data):
-    try:
-        with open(ROUND_SETTINGS_FILE, 'w', encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False, indent=4)
-    except: pass
+# 🔥 轮次起点存数据库（round_settings 表），多进程部署时所有 worker 看到的是同一份
+def get_round_start(c, device_id, template_id):
+    key = f"{device_id}_{template_id}"
+    c.execute("SELECT start_time FROM round_settings WHERE round_key IN (?, ?) ORDER BY round_key = ? DESC LIMIT 1", (key, device_id, key))
+    row = c.fetchone()
+    return row['start_time'] if row else None
+
+def save_round_start(c, device_id, template_id, start_time):
+    c.execute("REPLACE INTO round_settings (round_key, start_time) VALUES (?, ?)", (f"{device_id}_{template_id}", start_time))
+
+def get_round_cutoff(c, device_id, template_id, now):
+    """总览统计起点：最近 48 小时（取整到分钟）与本轮开始时间中较晚的一个"""
+    cutoff_time = (now - timedelta(hours=48)).replace(second=0, microsecond=0); round_start = get_round_start(c, device_id, template_id)
+    if round_start:
+        try: cutoff_time = max(cutoff_time, datetime.strptime(round_start, '%Y-%m-%d %H:%M:%S'))
+        except: pass
+    return cutoff_time, round_start
+
+# 🔥 /api/stats 响应缓存：每个 (设备, 模板) 保存最近一次结果，签名不变就直接复用（配合 ETag 返回 304）
+# 数据版本号存在 stats_versions 表里，任何 worker 写入后其他 worker 的缓存也会失效
+stats_cache = {}
 
-round_start_times = load_round_times()
+def invalidate_stats(c, device_id):
+    """设备有新日志入库、手工修正、重置轮次或切换模板后调用（随调用方事务一起提交）"""
+    c.execute("INSERT INTO stats_versions (device_id, version) VALUES (?, 1) ON CONFLICT (device_id) DO UPDATE SET version = version + 1", (device_id,))
+
+def invalidate_all_stats(c):
+    """重建汇总这类影响所有设备的操作之后调用"""
+    c.execute('''INSERT INTO stats_versions (device_id, version)
+                 SELECT device_id, 1 FROM (SELECT device_id FROM devices UNION SELECT device_id FROM daily_rollups) WHERE device_id IS NOT NULL
+                 ON CONFLICT (device_id) DO UPDATE SET version = version + 1''')
+
+def get_stats_version(c, device_id):
+    c.execute("SELECT version FROM stats_versions WHERE device_id = ?", (device_id,))
+    row = c.fetchone()
+    return row['version'] if row else 0
+
+def stats_response(body, etag):
+    # 弱 ETag：gzip 钩子可能压缩响应体，压缩版和原文共用同一个校验值
+    resp = app.response_class(body, mimetype='application/json')
+    resp.set_etag(etag, weak=True); resp.headers['Cache-Control'] = 'no-cache'
+    return resp.make_conditional(request)
 
 def parse_log_date(date_str):
     try:
@@ -72,47 +139,1125 @@ def parse_log_date(date_str):
         return None
     except: return None
 
-def init_db():
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row; c = conn.cursor()
+# 🔥 log_ts：把 log_time 归一化为整数秒（按本地时间当作 UTC 计算，与时区无关），用于在 SQL 里做范围过滤
+def to_log_ts(dt): return calendar.timegm(dt.timetuple()) if dt else None
+
+def log_ts_of(date_str): return to_log_ts(parse_log_date(date_str))
+
+# 🔥 日志模板引擎：每个模板注册一次，正则只编译一次。fast_pattern 是锚定行首、没有惰性回溯的快速正则，
+# 只覆盖标准写法；它匹配不上时再退回原正则，所以解析结果和原正则完全一致
+LOG_PARSERS = {}    # 模板元数据（名称、客户端找文件的规则），/api/templates 和心跳直接返回
+LOG_TEMPLATES = {}  # template_id -> LogTemplate
+QUANTITY_RE = re.compile(r'\d+')
+PIXIU_TIME_TABLE = str.maketrans({'年': '-', '月': '-', '日': None, '时': ':', '分': ':', '秒': None})
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+@functools.lru_cache(maxsize=4096)
+def ymd_day_ts(ymd):
+    """'YYYY-MM-DD' / 'YYYY/MM/DD' / 'YYYY.MM.DD' 当天 0 点的 log_ts，不是定长合法日期返回 None；同一天的日志很多，按字符串缓存"""
+    digits = ymd[0:4] + ymd[5:7] + ymd[8:10]
+    if len(ymd) != 10 or ymd[4] != ymd[7] or ymd[4] not in '-/.' or not (digits.isascii() and digits.isdigit()): return None
+    try: return (date(int(ymd[0:4]), int(ymd[5:7]), int(ymd[8:10])).toordinal() - EPOCH_ORDINAL) * DAY_SECONDS
+    except ValueError: return None
+
+@functools.lru_cache(maxsize=4096)
+def dmy_day_ts(dmy):
+    """'DD/Mon/YYYY' 当天 0 点的 log_ts，同上"""
+    digits = dmy[0:2] + dmy[7:11]
+    if len(dmy) != 11 or dmy[2] != '/' or dmy[6] != '/' or dmy[3:6] not in MONTH_MAP or not (digits.isascii() and digits.isdigit()): return None
+    try: return (date(int(dmy[7:11]), MONTH_MAP[dmy[3:6]], int(dmy[0:2])).toordinal() - EPOCH_ORDINAL) * DAY_SECONDS
+    except ValueError: return None
+
+@functools.lru_cache(maxsize=1 << 17)
+def hms_seconds(hms):
+    """'HH:MM:SS' 是当天第几秒，不是定长合法时间返回 None"""
+    digits = hms[0:2] + hms[3:5] + hms[6:8]
+    if len(hms) != 8 or hms[2] != ':' or hms[5] != ':' or not (digits.isascii() and digits.isdigit()): return None
+    h, m, s = int(hms[0:2]), int(hms[3:5]), int(hms[6:8])
+    return h * 3600 + m * 60 + s if h < 24 and m < 60 and s < 60 else None
+
+def fast_log_ts(date_str):
+    """log_ts_of 的快速版：定长的 YYYY-MM-DD / YYYY/MM/DD / YYYY.MM.DD 和 DD/Mon/YYYY 按日期、时刻分别查缓存，其他写法仍走 parse_log_date"""
+    if len(date_str) == 19 and date_str[10] == ' ': day = ymd_day_ts(date_str[:10]); sec = hms_seconds(date_str[11:])
+    elif len(date_str) == 20 and date_str[11] == ' ': day = dmy_day_ts(date_str[:11]); sec = hms_seconds(date_str[12:])
+    else: day = sec = None
+    if day is None or sec is None: return log_ts_of(date_str)
+    return day + sec
+
+# 按写法固定的换算函数：不再逐行按长度分派，形状不对（少见）时才退回 fast_log_ts
+def ymd_log_ts(date_str):
+    day = ymd_day_ts(date_str[:10]); sec = hms_seconds(date_str[11:])
+    if day is None or sec is None or date_str[10:11] != ' ': return fast_log_ts(date_str)
+    return day + sec
+
+def dmy_log_ts(date_str):
+    day = dmy_day_ts(date_str[:11]); sec = hms_seconds(date_str[12:])
+    if day is None or sec is None or date_str[11:12] != ' ': return fast_log_ts(date_str)
+    return day + sec
+
+def pick_log_ts(sample):
+    """按样本时间的写法选定换算函数（同一个日志文件里写法是固定的）"""
+    if len(sample) == 20 and sample[2:3] == '/': return dmy_log_ts
+    if len(sample) == 19: return ymd_log_ts
+    return fast_log_ts
+
+class LogTemplate:
+    """一种日志格式：parse(line) -> (log_time, nickname, item_type, quantity) 或 None；converter(样本时间) -> 整个上传共用的 log_ts 换算函数"""
+    def __init__(self, template_id, pattern, item_type, fast_pattern=None, requires=(), parse=None, to_ts=None):
+        self.id = template_id; self.item_type = item_type; self.requires = requires; self.to_ts = to_ts
+        self.regex = re.compile(pattern); self.fast = re.compile(fast_pattern) if fast_pattern else None
+        if parse: self.parse = parse
+
+    def parse(self, line):
+        for token in self.requires:
+            if token not in line: return None  # 缺必需的字面量，原正则不可能匹配，直接跳过（模板选错时大部分行在这里就被挡掉）
+        match = (self.fast and self.fast.match(line)) or self.regex.search(line)
+        if not match: return None
+        return match.group(1), match.group(2), self.item_type, int(match.group(3))
+
+    def converter(self, sample): return self.to_ts or pick_log_ts(sample)
+
+def register_template(template_id, name, pattern, item_type, file_rule, folder_rule, fast_pattern=None, requires=(), parse=None, to_ts=None):
+    """注册日志模板：模板列表、心跳下发的文件规则、上传解析和格式识别都从这里取，新增格式只需要再注册一个。
+    requires 是原正则必然包含的字面量（用作预筛）；to_ts 固定时间换算函数，不传则每次上传按第一行的写法选定"""
+    LOG_PARSERS[template_id] = {"name": name, "pattern": pattern, "item_type": item_type, "file_rule": file_rule, "folder_rule": folder_rule}
+    LOG_TEMPLATES[template_id] = LogTemplate(template_id, pattern, item_type, fast_pattern, requires, parse, to_ts)
+
+def get_template(template_id): return LOG_TEMPLATES.get(template_id) or LOG_TEMPLATES['default']
+
+def parse_pixiu_line(line):
+    # 貔貅是固定的 ---- 分隔格式，直接 split，避免惰性正则回溯；年月日时分秒 转成 '-' 格式入库
+    parts = line.split('----', 4)
+    if len(parts) < 5: return None
+    raw = parts[0]; nick = parts[3]; raw_val = parts[4]
+    # 标准写法 YYYY年MM月DD日 HH时MM分SS秒 按位置拼接（结果是纯 ASCII 才说明没有别的汉字混在里面），其他写法逐字替换
+    log_time = None
+    if len(raw) == 21 and raw[4:11:3] == '年月日' and raw[14::3] == '时分秒':
+        log_time = f"{raw[:4]}-{raw[5:7]}-{raw[8:10]}{raw[11:14]}:{raw[15:17]}:{raw[18:20]}"
+        if not log_time.isascii(): log_time = None
+    if log_time is None: log_time = raw.translate(PIXIU_TIME_TABLE)
+    if '钻' in raw_val:
+        q_match = QUANTITY_RE.search(raw_val)
+        return log_time, nick, "钻石", int(q_match.group()) if q_match else 1
+    return log_time, nick, raw_val, 1
+
+register_template("default", "万花筒 (仅限 lot.txt)", r"\[(.*?)\]\s+(.*?)_\d+\s+\|.*?[,，]\s*(?:.*?)[,，]\s*(\d+)", "钻石", "lot.txt", "",
+                  fast_pattern=r"\[([^\]]*)\]\s+([^|]*)_\d+\s+\|[^,，]*[,，][^,，]*[,，]\s*(\d+)", requires=('|',))
+register_template("qilin", "麒麟 (logs 目录多文档)", r"\[(.*?)\]\s*恭喜\[(.*?)\].*?中了-(\d+)-", "钻石", "*qiling.txt", "logs",
+                  fast_pattern=r"\[([^\]]*)\]\s*恭喜\[([^\]]*)\][^中]*中了-(\d+)-", requires=('恭喜[', '中了-'))
+register_template("pixiu", "貔貅 (含实物动态解析)", r"^(.*?)----.*?----.*?----(.*?)----(.*)$", "动态", "*中奖记录.txt", "中奖记录", parse=parse_pixiu_line, to_ts=ymd_log_ts)
+
+def detect_template(lines, prefer=None):
+    """用上传的前若干行给所有模板打分（解析成功且时间有效的行数），返回得分最高的模板，平分时优先 prefer；都不匹配返回 ''"""
+    best = ''; best_score = 0
+    for template_id, tpl in LOG_TEMPLATES.items():
+        score = 0
+        for line in lines:
+            parsed = tpl.parse(line)
+            if parsed and tpl.converter(parsed[0])(parsed[0]) is not None: score += 1
+        if score > best_score or (score and score == best_score and template_id == prefer): best = template_id; best_score = score
+    return best
+
+def backfill_log_ts(conn, batch_size=5000):
+    c = conn.cursor(); last_id = 0
+    while True:
+        c.execute("SELECT id, log_time FROM logs WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size))
+        rows = c.fetchall()
+        if not rows: break
+        updates = [(ts, r['id']) for r in rows for ts in [fast_log_ts(r['log_time'] or '')] if ts is not None]
+        c.executemany("UPDATE logs SET log_ts = ? WHERE id = ?", updates)
+        last_id = rows[-1]['id']
+
+def rebuild_rollups(conn):
+    """从热库 logs 重建 daily_rollups。归档线（整天对齐）之前的原始行已经搬进归档库，那些天的汇总保留不动，只重建归档线之后的"""
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archive_state'")
+    horizon = archive_horizon(c) if c.fetchone() else None
+    if horizon is None: c.execute("DELETE FROM daily_rollups")
+    else: c.execute("DELETE FROM daily_rollups WHERE day >= ?", (day_str(horizon),))
+    c.execute('''INSERT INTO daily_rollups (device_id, template_id, day, nickname, item_type, win_times, win_sum)
+                 SELECT device_id, template_id, date(log_ts, 'unixepoch'), COALESCE(nickname, ''), COALESCE(item_type, ''), COUNT(*), SUM(COALESCE(quantity, 0))
+                 FROM logs WHERE log_ts IS NOT NULL AND log_ts >= ? GROUP BY 1, 2, 3, 4, 5''', (horizon or -2 ** 62,))
+
+def day_str(ts): return time.strftime('%Y-%m-%d', time.gmtime(ts))
+
+def query_rollup_range(c, device_id, template_id, start_ts=None, end_ts=None, nickname=None, query_name='rollup_range'):
+    """按 (nickname, item_type) 汇总 [start_ts, end_ts] 内的 [中奖次数, 数量]：整天走 daily_rollups，首尾不满一天的部分回查 logs"""
+    lo = None if start_ts is None else -(-start_ts // DAY_SECONDS) * DAY_SECONDS  # 第一个完整天的起点
+    hi = None if end_ts is None else (end_ts + 1) // DAY_SECONDS * DAY_SECONDS    # 最后一个完整天的终点（不含）
+    where = " WHERE device_id = ? AND template_id = ?"; base = [device_id, template_id]
+    if nickname is not None: where += " AND nickname = ?"; base.append(nickname)
+    queries = []; archived = False
+    def add_raw(lo_ts, hi_ts):
+        # 不满一天的部分查原始行，范围早于归档线时连同归档库一起查
+        nonlocal archived
+        for src in log_sources(c, lo_ts, hi_ts):
+            archived |= src != "logs"
+            queries.append(("SELECT nickname, item_type, COUNT(*) AS win_times, SUM(quantity) AS win_sum FROM " + src + where + " AND log_ts >= ? AND log_ts < ? GROUP BY nickname, item_type", base + [lo_ts, hi_ts]))
+    if lo is not None and hi is not None and lo >= hi: add_raw(start_ts, end_ts + 1)
+    else:
+        roll_sql = "SELECT nickname, item_type, SUM(win_times) AS win_times, SUM(win_sum) AS win_sum FROM daily_rollups" + where; roll_args = list(base)
+        if lo is not None:
+            roll_sql += " AND day >= ?"; roll_args.append(day_str(lo))
+            if start_ts < lo: add_raw(start_ts, lo)
+        if hi is not None:
+            roll_sql += " AND day < ?"; roll_args.append(day_str(hi))
+            if end_ts >= hi: add_raw(hi, end_ts + 1)
+        queries.append((roll_sql + " GROUP BY nickname, item_type", roll_args))
+    merged = {}
+    try:
+        for sql, args in queries:
+            for r in fetch_all(c, query_name, sql, args):
+                m = merged.setdefault((r['nickname'], r['item_type']), [0, 0]); m[0] += r['win_times']; m[1] += r['win_sum'] or 0
+    finally:
+        if archived: detach_archives(c)
+    return merged
+
+# 🔥 冷热分层：早于保留线的日志按月搬到 ARCHIVE_DIR/logs-YYYY-MM.db，热库只留近期数据
+# daily_rollups 不搬，历史页和整天区间求和照旧只查热库；只有要读原始行（首尾不满一天、某天明细、本轮明细）且范围早于归档线时才只读 ATTACH 对应月份
+LOG_COLUMNS = "id, log_time, nickname, item_type, quantity, unique_sign, device_id, template_id, log_ts"
+
+def month_key(ts): return time.strftime('%Y-%m', time.gmtime(ts))
+
+def month_start(key): return calendar.timegm((int(key[:4]), int(key[5:7]), 1, 0, 0, 0))
+
+def next_month_start(key): y, m = int(key[:4]), int(key[5:7]); return calendar.timegm((y + m // 12, m % 12 + 1, 1, 0, 0, 0))
+
+def archive_path(key): return os.path.join(ARCHIVE_DIR, f"logs-{key}.db")
+
+def archive_horizon(c):
+    c.execute("SELECT horizon_ts FROM archive_state WHERE id = 1"); row = c.fetchone()
+    return row['horizon_ts'] if row else None
+
+def log_sources(c, start_ts=None, end_ts=None):
+    """覆盖 [start_ts, end_ts) 的日志表名列表：总有热库 logs；范围早于归档线时再 ATTACH 对应月份的归档（只读），最多 ARCHIVE_MAX_ATTACHED 个最近的月份。
+    返回多于一个表时，调用方用完要 detach_archives"""
+    horizon = archive_horizon(c)
+    if horizon is None or (start_ts is not None and start_ts >= horizon): return ["logs"]
+    hi = horizon if end_ts is None else min(end_ts, horizon)
+    c.execute("SELECT month FROM archive_months WHERE month >= ? AND month <= ? ORDER BY month DESC LIMIT ?",
+              (month_key(start_ts) if start_ts is not None else '', month_key(max(hi - 1, 0)), ARCHIVE_MAX_ATTACHED))
+    months = [r['month'] for r in c.fetchall()]
+    if not months: return ["logs"]
+    attached = {r['name'] for r in c.execute("PRAGMA database_list").fetchall()}
+    sources = ["logs"]
+    for key in months:
+        alias = "arch_" + key.replace('-', '_')
+        if alias not in attached:
+            if not os.path.exists(archive_path(key)): continue
+            c.execute(f"ATTACH DATABASE ? AS {alias}", ("file:" + urllib.parse.quote(archive_path(key)) + "?mode=ro",))
+        sources.append(f"{alias}.logs")
+    return sources
+
+def detach_archives(c):
+    for r in c.execute("PRAGMA database_list").fetchall():
+        if r['name'].startswith('arch_'): c.execute(f"DETACH DATABASE {r['name']}")
+
+def union_logs_sql(sources, columns, where):
+    """同一条 WHERE 分别下推到每个表，再 UNION ALL（参数按表数重复）"""
+    return " UNION ALL ".join(f"SELECT {columns} FROM {src} WHERE {where}" for src in sources)
+
+def filter_archived(c, rows):
+    """早于归档线的行（比如客户端全量重扫旧 lot.txt）先查对应月份归档，已归档过的丢掉，避免热库里出现重复、汇总重复累加"""
+    horizon = archive_horizon(c)
+    if horizon is None: return rows
+    by_month = {}
+    for i, row in enumerate(rows):
+        if row[7] is not None and row[7] < horizon: by_month.setdefault(month_key(row[7]), []).append(i)
+    if not by_month: return rows
+    dropped = set()
+    for key, idxs in by_month.items():
+        if not os.path.exists(archive_path(key)): continue
+        arch = sqlite3.connect("file:" + urllib.parse.quote(archive_path(key)) + "?mode=ro", uri=True)
+        try:
+            for i in idxs:
+                log_time, nick, _, quantity, _, device_id = rows[i][:6]
+                if arch.execute("SELECT 1 FROM logs WHERE device_id = ? AND log_time = ? AND nickname = ? AND quantity = ?", (device_id, log_time, nick, quantity)).fetchone(): dropped.add(i)
+        finally: arch.close()
+    return [row for i, row in enumerate(rows) if i not in dropped] if dropped else rows
+
+def archive_month(conn, key, start_ts, end_ts):
+    """先把这段复制进归档库并提交，再在热库的一个事务里删除并推进归档线；中途崩溃重跑是幂等的（归档侧 INSERT OR IGNORE）"""
+    c = conn.cursor()
+    c.execute("ATTACH DATABASE ? AS arch", (archive_path(key),))
+    try:
+        c.execute("CREATE TABLE IF NOT EXISTS arch.logs (id INTEGER PRIMARY KEY, log_time TEXT, nickname TEXT, item_type TEXT, quantity INTEGER, unique_sign TEXT, device_id TEXT, template_id TEXT, log_ts INTEGER)")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS arch.idx_logs_dedup ON logs (device_id, log_time, nickname, quantity)")
+        c.execute("CREATE INDEX IF NOT EXISTS arch.idx_logs_device_tpl_ts ON logs (device_id, template_id, log_ts)")
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(f"INSERT OR IGNORE INTO arch.logs ({LOG_COLUMNS}) SELECT {LOG_COLUMNS} FROM main.logs WHERE log_ts >= ? AND log_ts < ?", (start_ts, end_ts))
+        c.execute("COMMIT")
+        c.execute("SELECT COUNT(*) FROM arch.logs"); total = c.fetchone()[0]
+    finally: c.execute("DETACH DATABASE arch")
+    c.execute("BEGIN IMMEDIATE")
+    c.execute("DELETE FROM logs WHERE log_ts >= ? AND log_ts < ?", (start_ts, end_ts)); moved = c.rowcount
+    c.execute('''INSERT INTO archive_months (month, rows, archived_at) VALUES (?, ?, ?)
+                 ON CONFLICT (month) DO UPDATE SET rows = excluded.rows, archived_at = excluded.archived_at''', (key, total, time.time()))
+    c.execute("UPDATE archive_state SET horizon_ts = MAX(COALESCE(horizon_ts, 0), ?) WHERE id = 1", (end_ts,))
+    c.execute("COMMIT")
+    return moved
+
+def release_free_pages(c):
+    """auto_vacuum=INCREMENTAL 的库分步回收空闲页：每步一个短写事务，步间让出写锁，不像 VACUUM 那样整库重建期间一直占着。返回回收的页数"""
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2: return 0
+    released = 0
+    while True:
+        free = c.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free: break
+        # incremental_vacuum 每回收一页返回一步，execute 只走一步，要用 executescript 跑完
+        c.executescript(f"PRAGMA incremental_vacuum({ARCHIVE_VACUUM_PAGES})"); released += min(free, ARCHIVE_VACUUM_PAGES)
+        time.sleep(0.05)
+    return released
+
+def archive_logs(retention_days=None, vacuum=False, min_interval=0):
+    """把早于 retention_days 天（按整天对齐）的日志按月搬进归档库，然后增量回收热库的空闲页。
+    vacuum=True（只在 archive-logs 命令里用）改为整库 VACUUM，同时把老库切到 auto_vacuum=INCREMENTAL；VACUUM 期间写入会被阻塞，不要在 web 进程里跑。
+    min_interval > 0 时，距离上次运行不到这么久就跳过（多进程各自的定时线程靠这个只跑一个）"""
+    retention_days = LOG_RETENTION_DAYS if retention_days is None else retention_days
+    if retention_days <= 0: return None
+    retention_days = max(retention_days, 3)  # 总览的 48 小时窗口始终留在热库
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None); conn.row_factory = sqlite3.Row; c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT last_run FROM archive_state WHERE id = 1"); last_run = c.fetchone()['last_run'] or 0
+        if min_interval and time.time() - last_run < min_interval: c.execute("ROLLBACK"); return None
+        c.execute("UPDATE archive_state SET last_run = ? WHERE id = 1", (time.time(),)); c.execute("COMMIT")
+
+        started = time.time()
+        cutoff = to_log_ts(datetime.now()) // DAY_SECONDS * DAY_SECONDS - retention_days * DAY_SECONDS
+        c.execute("SELECT MIN(log_ts) FROM logs WHERE log_ts < ?", (cutoff,)); oldest = c.fetchone()[0]
+        moved = 0; months = []
+        if oldest is not None:
+            key = month_key(oldest)
+            while month_start(key) < cutoff:
+                moved += archive_month(conn, key, month_start(key), min(next_month_start(key), cutoff)); months.append(key)
+                key = month_key(next_month_start(key))
+        incremental = c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2; released = 0
+        vacuumed = bool(vacuum and (moved or not incremental))
+        if vacuumed:
+            c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            c.execute("PRAGMA wal_checkpoint(TRUNCATE)"); c.execute("VACUUM"); c.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        elif moved: released = release_free_pages(c)
+        result = {"cutoff": day_str(cutoff), "moved": moved, "months": months, "vacuumed": vacuumed, "released_pages": released, "seconds": round(time.time() - started, 3)}
+        if moved: print(f"Archived {moved} log rows older than {result['cutoff']} into {', '.join(months)} in {result['seconds']}s", flush=True)
+        return result
+    finally: conn.close()
+
+def archive_loop():
+    while True:
+        try: archive_logs(min_interval=ARCHIVE_INTERVAL_SECONDS)
+        except Exception as e: print(f"Archive Error: {e}", flush=True)
+        time.sleep(ARCHIVE_CHECK_SECONDS)
+
+def column_names(c, table):
+    c.execute(f"PRAGMA table_info({table})")
+    return [col['name'] for col in c.fetchall()]
+
+def add_column(c, table, column, decl):
+    if column not in column_names(c, table): c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+# 🔥 版本化迁移：每个迁移只在 schema_version 里没记录时执行一次，启动时只查一次版本号，和数据量无关
+def migrate_base_tables(conn):
+    c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY AUTOINCREMENT, log_time TEXT, nickname TEXT, item_type TEXT, quantity INTEGER, unique_sign TEXT UNIQUE, device_id TEXT)''')
     c.execute('''CREATE TABLE IF NOT EXISTS devices (device_id TEXT PRIMARY KEY, nickname TEXT, last_seen REAL, process_running INTEGER, first_seen REAL, password TEXT)''')
     c.execute('''CREATE TABLE IF NOT EXISTS daily_overrides (date TEXT, device_id TEXT, manual_users INTEGER, manual_sum INTEGER, PRIMARY KEY (date, device_id))''')
-    try: c.execute("ALTER TABLE devices ADD COLUMN template_id TEXT DEFAULT 'default'")
-    except: pass
-    try: c.execute("ALTER TABLE devices ADD COLUMN last_msg TEXT DEFAULT '正常'")
-    except: pass
-    try: c.execute("ALTER TABLE devices ADD COLUMN detected_template TEXT DEFAULT ''")
-    except: pass
-    try: c.execute("ALTER TABLE logs ADD COLUMN template_id TEXT DEFAULT 'default'")
-    except: pass
-    
-    c.execute("PRAGMA table_info(daily_overrides)")
-    columns = [col['name'] for col in c.fetchall()]
-    if 'template_id' not in columns:
+    add_column(c, 'devices', 'template_id', "TEXT DEFAULT 'default'")
+    add_column(c, 'devices', 'last_msg', "TEXT DEFAULT '正常'")
+    add_column(c, 'devices', 'detected_template', "TEXT DEFAULT ''")
+    add_column(c, 'logs', 'template_id', "TEXT DEFAULT 'default'")
+    if 'template_id' not in column_names(c, 'daily_overrides'):
         c.execute("ALTER TABLE daily_overrides RENAME TO daily_overrides_old")
         c.execute('''CREATE TABLE daily_overrides (date TEXT, device_id TEXT, template_id TEXT DEFAULT 'default', manual_users INTEGER, manual_sum INTEGER, PRIMARY KEY (date, device_id, template_id))''')
         c.execute("INSERT INTO daily_overrides (date, device_id, manual_users, manual_sum) SELECT date, device_id, manual_users, manual_sum FROM daily_overrides_old")
         c.execute("DROP TABLE daily_overrides_old")
 
-    try: c.execute('''DELETE FROM logs WHERE id NOT IN (SELECT MIN(id) FROM logs GROUP BY log_time, nickname, quantity, device_id)''')
-    except: pass
-    conn.commit(); conn.close()
+def migrate_dedup_logs(conn):
+    """旧版每次启动都全表去重；这里只清一次历史重复，之后由唯一索引 + INSERT OR IGNORE 在写入时挡掉"""
+    c = conn.cursor()
+    c.execute('''DELETE FROM logs WHERE id NOT IN (SELECT MIN(id) FROM logs GROUP BY log_time, nickname, quantity, device_id)''')
+    removed = c.rowcount
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_logs_dedup ON logs (device_id, log_time, nickname, quantity)")
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'daily_rollups'")
+    if removed > 0 and c.fetchone(): rebuild_rollups(conn)
+
+def migrate_log_ts(conn):
+    c = conn.cursor()
+    if 'log_ts' not in column_names(c, 'logs'):
+        c.execute("ALTER TABLE logs ADD COLUMN log_ts INTEGER")
+        backfill_log_ts(conn)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_device_tpl_ts ON logs (device_id, template_id, log_ts)")
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row
-    try: c = conn.cursor(); c.execute("SELECT 1 FROM devices LIMIT 1")
-    except sqlite3.OperationalError:
-        conn.close(); init_db(); conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row
-    return conn
+def migrate_upload_cursors(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS upload_cursors (device_id TEXT, template_id TEXT, file_name TEXT, byte_offset INTEGER, prefix_len INTEGER, prefix_hash TEXT, updated_at REAL, PRIMARY KEY (device_id, template_id, file_name))''')
+
+def migrate_daily_rollups(conn):
+    # 🔥 按天/用户的汇总表，由 logs 的插入触发器在同一事务内增量维护
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS daily_rollups (device_id TEXT, template_id TEXT, day TEXT, nickname TEXT, item_type TEXT, win_times INTEGER, win_sum INTEGER, PRIMARY KEY (device_id, template_id, day, nickname, item_type))''')
+    rebuild_rollups(conn)
+    # 历史页日期统一成 YYYY-MM-DD，旧的手工修正记录同步改写
+    c.execute("UPDATE OR REPLACE daily_overrides SET date = replace(replace(date, '/', '-'), '.', '-') WHERE date GLOB '[0-9][0-9][0-9][0-9][/.][0-9][0-9][/.][0-9][0-9]'")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_logs_rollup AFTER INSERT ON logs WHEN NEW.log_ts IS NOT NULL BEGIN
+                     INSERT INTO daily_rollups (device_id, template_id, day, nickname, item_type, win_times, win_sum)
+                     VALUES (NEW.device_id, NEW.template_id, date(NEW.log_ts, 'unixepoch'), COALESCE(NEW.nickname, ''), COALESCE(NEW.item_type, ''), 1, COALESCE(NEW.quantity, 0))
+                     ON CONFLICT (device_id, template_id, day, nickname, item_type) DO UPDATE SET win_times = win_times + 1, win_sum = win_sum + excluded.win_sum;
+                 END''')
+
+def migrate_shared_state(conn):
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'round_settings'")
+    if not c.fetchone():
+        c.execute('''CREATE TABLE round_settings (round_key TEXT PRIMARY KEY, start_time TEXT)''')
+        c.executemany("INSERT OR REPLACE INTO round_settings (round_key, start_time) VALUES (?, ?)", list(load_round_times().items()))
+    c.execute('''CREATE TABLE IF NOT EXISTS stats_versions (device_id TEXT PRIMARY KEY, version INTEGER)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, node_id TEXT, event TEXT, data TEXT, created_at REAL)''')
+
+def migrate_archive_state(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS archive_state (id INTEGER PRIMARY KEY CHECK (id = 1), horizon_ts INTEGER, last_run REAL)''')
+    c.execute("INSERT OR IGNORE INTO archive_state (id, horizon_ts, last_run) VALUES (1, NULL, 0)")
+    c.execute('''CREATE TABLE IF NOT EXISTS archive_months (month TEXT PRIMARY KEY, rows INTEGER, archived_at REAL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_ts ON logs (log_ts)")
+
+def migrate_stream_subscribers(conn):
+    conn.cursor().execute('''CREATE TABLE IF NOT EXISTS stream_subscribers (node_id TEXT, owner TEXT, expires_at REAL, PRIMARY KEY (node_id, owner))''')
+
+# 只能往后追加；已发布的迁移不要改序号，也不要改内容
+MIGRATIONS = [
+    (1, migrate_base_tables),
+    (2, migrate_dedup_logs),
+    (3, migrate_log_ts),
+    (4, migrate_upload_cursors),
+    (5, migrate_daily_rollups),
+    (6, migrate_shared_state),
+    (7, migrate_archive_state),
+    (8, migrate_stream_subscribers),
+]
+
+def init_db():
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, timeout=30); conn.row_factory = sqlite3.Row; c = conn.cursor()
+    c.execute("PRAGMA auto_vacuum = INCREMENTAL")  # 只对还没建表的新库生效，老库跑一次 archive-logs --vacuum 切换
+    c.execute("PRAGMA journal_mode = WAL")
+    c.execute('''CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name TEXT, applied_at REAL)''')
+    c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    if c.fetchone()[0] >= MIGRATIONS[-1][0]: conn.close(); return
+    for version, migrate in MIGRATIONS:
+        # 每个迁移一个写事务（SQLite 的 DDL 可回滚）；多进程同时启动时拿到锁后再确认一次版本
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,))
+            if c.fetchone(): c.execute("COMMIT"); continue
+            started = time.time(); migrate(conn)
+            c.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)", (version, migrate.__name__, time.time()))
+            c.execute("COMMIT")
+            print(f"Schema migration {version} ({migrate.__name__}) applied in {time.time() - started:.2f}s", flush=True)
+        except:
+            c.execute("ROLLBACK"); conn.close(); raise
+    conn.close()
+
+# 🔥 连接池：连接复用 + WAL，读（/api/stats）不再阻塞写（/upload）；close() 只是把连接还回池里
+class PooledConnection:
+    def __init__(self, pool, conn): self._pool = pool; self._conn = conn
+    def __getattr__(self, name): return getattr(self._conn, name)
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None: self._pool.release(conn)
+
+class ConnectionPool:
+    PRAGMAS = ("PRAGMA journal_mode = WAL", "PRAGMA synchronous = NORMAL", "PRAGMA busy_timeout = 10000",
+               "PRAGMA temp_store = MEMORY", "PRAGMA cache_size = -16000", "PRAGMA mmap_size = 268435456")
+
+    def __init__(self, path, size):
+        self.path = path; self.size = size; self.pid = os.getpid(); self.idle = queue.LifoQueue()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, uri=True); conn.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS: conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        if os.getpid() != self.pid: self.pid = os.getpid(); self.idle = queue.LifoQueue()  # fork 之后不复用父进程的连接
+        try: conn = self.idle.get_nowait()
+        except queue.Empty: conn = self._connect()
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        if conn.in_transaction: conn.rollback()
+        if os.getpid() == self.pid and self.idle.qsize() < self.size: self.idle.put(conn)
+        else: conn.close()
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+
+def get_db_connection(): return db_pool.acquire()
 
 init_db()
+if LOG_RETENTION_DAYS > 0: threading.Thread(target=archive_loop, name="log-archiver", daemon=True).start()
+
+# 🔥 指标：进程内累加（热路径只是加锁 += 几个数），定期写到 METRICS_DIR/<pid>.json，/api/metrics 汇总所有 worker 和解析进程
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_HELP = {
+    "lot_http_request_duration_seconds": ("histogram", "HTTP 请求耗时（按路由）"),
+    "lot_http_requests_total": ("counter", "HTTP 请求数（按路由、状态码）"),
+    "lot_query_duration_seconds": ("histogram", "SQLite 查询耗时（按命名查询）"),
+    "lot_upload_lines_total": ("counter", "上传收到的日志行数"),
+    "lot_upload_matched_total": ("counter", "模板匹配成功的行数"),
+    "lot_upload_inserted_total": ("counter", "实际入库的行数"),
+    "lot_upload_deduplicated_total": ("counter", "匹配成功但因重复被忽略的行数"),
+    "lot_heartbeats_total": ("counter", "收到的心跳数"),
+    "lot_devices_online": ("gauge", "在线设备数"),
+    "lot_devices_total": ("gauge", "已登记设备数"),
+}
+
+class Metrics:
+    def __init__(self, flush_interval=METRICS_FLUSH_SECONDS):
+        self.flush_interval = flush_interval; self._reset()
+        os.register_at_fork(after_in_child=self._reset)  # fork 出来的进程从零开始计数，也不继承父进程的锁和线程
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self.lock = threading.Lock(); self.counters = {}; self.histograms = {}; self.flusher = None
+
+    def _ensure_flusher(self):
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush_loop, name="metrics-flusher", daemon=True); self.flusher.start()
+
+    def inc(self, name, labels=(), amount=1):
+        with self.lock:
+            self._ensure_flusher(); key = (name, labels); self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            self._ensure_flusher(); key = (name, labels); h = self.histograms.get(key)
+            if h is None: h = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 3)  # 各桶计数（最后一个是 +Inf）、sum、count
+            h[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1; h[-2] += value; h[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"pid": os.getpid(), "updated_at": time.time(),
+                    "counters": [[n, [list(l) for l in labels], v] for (n, labels), v in self.counters.items()],
+                    "histograms": [[n, [list(l) for l in labels], list(h)] for (n, labels), h in self.histograms.items()]}
+
+    def flush(self):
+        with self.lock:
+            if not self.counters and not self.histograms: return
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            tmp = os.path.join(METRICS_DIR, f"{os.getpid()}.json.tmp")
+            with open(tmp, 'w', encoding='utf-8') as f: json.dump(self.snapshot(), f)
+            os.replace(tmp, os.path.join(METRICS_DIR, f"{os.getpid()}.json"))
+        except Exception as e: print(f"Metrics Flush Error: {e}", flush=True)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval); self.flush()
+
+    def collect(self):
+        """本进程的实时数据 + 其他进程最近落盘的数据，合并成 {(name, labels): 值或直方图}"""
+        snapshots = [self.snapshot()]; now = time.time()
+        try: names = os.listdir(METRICS_DIR)
+        except OSError: names = []
+        for name in names:
+            if not name.endswith('.json') or name == f"{os.getpid()}.json": continue
+            path = os.path.join(METRICS_DIR, name)
+            try:
+                with open(path, encoding='utf-8') as f: snap = json.load(f)
+            except (OSError, ValueError): continue
+            if now - snap.get('updated_at', 0) > METRICS_STALE_SECONDS:
+                try: os.remove(path)  # 已退出的进程
+                except OSError: pass
+                continue
+            snapshots.append(snap)
+        counters = {}; histograms = {}
+        for snap in snapshots:
+            for n, labels, v in snap['counters']:
+                key = (n, tuple(tuple(l) for l in labels)); counters[key] = counters.get(key, 0) + v
+            for n, labels, h in snap['histograms']:
+                key = (n, tuple(tuple(l) for l in labels)); acc = histograms.setdefault(key, [0] * len(h))
+                for i, v in enumerate(h): acc[i] += v
+        return counters, histograms
+
+metrics = Metrics()
+
+def fetch_all(c, name, sql, args=()):
+    """执行查询并取回全部结果，按名字记录耗时；开启慢请求日志时顺便记下语句，超时后对它跑 EXPLAIN QUERY PLAN"""
+    started = time.perf_counter(); c.execute(sql, args); rows = c.fetchall()
+    elapsed = time.perf_counter() - started
+    metrics.observe("lot_query_duration_seconds", (("query", name),), elapsed)
+    if SLOW_REQUEST_SECONDS and has_request_context(): g.setdefault('queries', []).append((elapsed, name, sql, tuple(args)))
+    return rows
+
+def record_ingest(template_id, result):
+    labels = (("template", template_id),)
+    metrics.inc("lot_upload_lines_total", labels, result['lines']); metrics.inc("lot_upload_matched_total", labels, result['matched'])
+    metrics.inc("lot_upload_inserted_total", labels, result['inserted']); metrics.inc("lot_upload_deduplicated_total", labels, result['matched'] - result['inserted'])
+
+def log_slow_request(route, elapsed):
+    lines = [f"Slow Request: {request.method} {request.full_path} ({route}) {elapsed * 1000:.1f}ms"]
+    queries = sorted(g.get('queries', []), key=lambda q: q[0], reverse=True)[:3]
+    if queries:
+        conn = get_db_connection(); c = conn.cursor()
+        for q_elapsed, name, sql, args in queries:
+            lines.append(f"  {name}: {q_elapsed * 1000:.1f}ms")
+            try: lines += [f"    {r['detail']}" for r in c.execute("EXPLAIN QUERY PLAN " + sql, args).fetchall()]
+            except Exception as e: lines.append(f"    (no plan: {e})")
+        conn.close()
+    print("\n".join(lines), flush=True)
+
+def prom_escape(value): return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prom_labels(labels): return "{" + ",".join(f'{k}="{prom_escape(v)}"' for k, v in labels) + "}" if labels else ""
+
+@app.before_request
+def start_request_timer(): g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None: return response
+    elapsed = time.perf_counter() - started; route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe("lot_http_request_duration_seconds", (("route", route), ("method", request.method)), elapsed)
+    metrics.inc("lot_http_requests_total", (("route", route), ("method", request.method), ("status", str(response.status_code))))
+    if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS:
+        try: log_slow_request(route, elapsed)
+        except Exception as e: print(f"Slow Request Log Error: {e}", flush=True)
+    return response
+
+def encode_log_rows(rows, columnar=False):
+    """明细行编码：默认是 dict 列表；columnar 时每个字段一个数组，昵称和物品类型只传一次字典、行里存下标"""
+    if not columnar: return [dict(r) for r in rows]
+    nicks = {}; types = {}
+    out = {"id": [], "log_time": [], "nickname": [], "item_type": [], "quantity": []}
+    for r in rows:
+        out["id"].append(r['id']); out["log_time"].append(r['log_time']); out["quantity"].append(r['quantity'])
+        out["nickname"].append(nicks.setdefault(r['nickname'], len(nicks))); out["item_type"].append(types.setdefault(r['item_type'], len(types)))
+    out["nicknames"] = list(nicks); out["item_types"] = list(types)
+    return out
+
+def query_log_page(c, name, device_id, template_id, start_ts, end_ts=None, before_id=None, after_id=None, limit=None):
+    """按 id 游标分页取明细（新的在前）：before_id 取更早的一页，after_id 取更新的一页，limit=None 不分页。
+    多取一行判断 has_more；范围早于归档线时连同归档库一起查。返回 (rows, has_more)"""
+    where = "device_id = ? AND template_id = ? AND log_ts >= ?"; args = [device_id, template_id, start_ts]
+    if end_ts is not None: where += " AND log_ts < ?"; args.append(end_ts)
+    if before_id is not None: where += " AND id < ?"; args.append(before_id)
+    if after_id is not None: where += " AND id > ?"; args.append(after_id)
+    ascending = after_id is not None and before_id is None
+    sources = log_sources(c, start_ts, end_ts)
+    try:
+        sql = union_logs_sql(sources, "id, log_time, nickname, item_type, quantity", where) + (" ORDER BY id ASC" if ascending else " ORDER BY id DESC") + (" LIMIT ?" if limit else "")
+        rows = fetch_all(c, name, sql, args * len(sources) + ([limit + 1] if limit else []))
+    finally:
+        if len(sources) > 1: detach_archives(c)
+    has_more = bool(limit) and len(rows) > limit
+    if limit: rows = rows[:limit]
+    if ascending: rows.reverse()
+    return rows, has_more
+
+def log_page_payload(key, rows, has_more, columnar):
+    return {key: encode_log_rows(rows, columnar), "has_more": has_more, "format": "columns" if columnar else "rows",
+            "oldest_id": rows[-1]['id'] if rows else None, "newest_id": rows[0]['id'] if rows else None}
+
+def page_args(default_limit):
+    # limit 缺省或为 0 时用 default_limit；只有 default_limit 本身是 None（/api/history_logs）才不限行数
+    limit = request.args.get('limit', type=int) or default_limit
+    return (request.args.get('before_id', type=int), request.args.get('after_id', type=int),
+            max(1, min(limit, DETAILS_PAGE_MAX)) if limit is not None else None, request.args.get('format') == 'columns')
+
+@app.after_request
+def gzip_response(response):
+    """JSON / 页面 / 指标响应按 Accept-Encoding 做 gzip（SSE 等流式响应、静态文件不动）"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed or response.mimetype not in GZIP_MIMETYPES
+            or 'Content-Encoding' in response.headers or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()): return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_BYTES: return response
+    response.set_data(gzip.compress(data, 6)); response.headers['Content-Encoding'] = 'gzip'; response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag and not weak: response.set_etag(etag, weak=True)  # 强 ETag 要求字节完全一致，压缩后只能降为弱 ETag
+    return response
+
+def device_status_text(last_msg, last_seen, process_running):
+    if last_msg == "模板错误": return "模板错误"
+    if (time.time() - (last_seen or 0)) >= ONLINE_WINDOW_SECONDS: return "离线"
+    return "运行中" if process_running else "未运行"
+
+# 🔥 SSE 推送：每个浏览器连接一个队列，按节点分发增量事件
+# 事件先写入 events 表，每个进程一个轮询线程取出后分发给本进程的订阅者，所以多 worker / 多线程部署都能收到
+# 哪些节点有人在看登记在 stream_subscribers 表里（带过期时间），没人看的节点不写事件
+class EventBroker:
+    def __init__(self, poll_interval=SSE_POLL_SECONDS):
+        self.lock = threading.Lock(); self.subscribers = {}; self.poll_interval = poll_interval
+        self.poller = None; self.poller_pid = None; self.owner = None; self.last_prune = 0
+
+    def subscribe(self, node_id):
+        q = queue.Queue(maxsize=256)
+        with self.lock:
+            self.subscribers.setdefault(node_id, set()).add(q)
+            if self.poller_pid != os.getpid():
+                self.poller_pid = os.getpid(); self.owner = uuid.uuid4().hex
+                conn = get_db_connection(); start_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]; conn.close()
+                self.poller = threading.Thread(target=self._poll_loop, args=(start_id,), name="sse-poller", daemon=True); self.poller.start()
+            self._register([node_id])
+        return q
+
+    def unsubscribe(self, node_id, q):
+        with self.lock:
+            subs = self.subscribers.get(node_id)
+            if subs:
+                subs.discard(q)
+                if not subs:
+                    del self.subscribers[node_id]
+                    conn = get_db_connection()
+                    try: conn.execute("DELETE FROM stream_subscribers WHERE node_id = ? AND owner = ?", (node_id, self.owner)); conn.commit()
+                    finally: conn.close()
+
+    def _register(self, node_ids):
+        if not node_ids: return
+        conn = get_db_connection()
+        try:
+            conn.executemany("INSERT INTO stream_subscribers (node_id, owner, expires_at) VALUES (?, ?, ?) ON CONFLICT (node_id, owner) DO UPDATE SET expires_at = excluded.expires_at",
+                             [(node_id, self.owner, time.time() + SSE_SUBSCRIBER_TTL_SECONDS) for node_id in node_ids])
+            conn.commit()
+        finally: conn.close()
+
+    def has_subscribers(self, node_id, c=None):
+        """任意进程里有没有浏览器在看这个节点；c 为调用方已有的连接/游标，省一次取连接"""
+        if node_id in self.subscribers: return True
+        conn = c or get_db_connection()
+        try: row = conn.execute("SELECT 1 FROM stream_subscribers WHERE node_id = ? AND expires_at > ? LIMIT 1", (node_id, time.time())).fetchone()
+        finally:
+            if c is None: conn.close()
+        return row is not None
+
+    def publish(self, node_id, event, data):
+        conn = get_db_connection()
+        try:
+            if not self.has_subscribers(node_id, conn): return
+            conn.execute("INSERT INTO events (node_id, event, data, created_at) VALUES (?, ?, ?, ?)", (node_id, event, json.dumps(data, ensure_ascii=False), time.time()))
+            conn.commit()
+        finally: conn.close()
+
+    def prune(self):
+        """清理过期事件和过期的订阅登记；由一直在跑的 presence 刷写线程调用，所以没人打开过推送的进程也会清"""
+        now = time.time()
+        if now - self.last_prune < 60: return
+        self.last_prune = now; conn = get_db_connection()
+        try:
+            conn.execute("DELETE FROM events WHERE created_at < ?", (now - SSE_EVENT_TTL_SECONDS,))
+            conn.execute("DELETE FROM stream_subscribers WHERE expires_at < ?", (now,)); conn.commit()
+        finally: conn.close()
+
+    def _dispatch(self, node_id, event, data):
+        with self.lock: subs = list(self.subscribers.get(node_id, ()))
+        for q in subs:
+            try: q.put_nowait((event, data))
+            except queue.Full: pass  # 慢客户端直接丢弃，前端兜底轮询会补齐
+
+    def _poll_loop(self, last_id):
+        last_renew = time.time()
+        while True:
+            try:
+                conn = get_db_connection()
+                try: rows = conn.execute("SELECT id, node_id, event, data FROM events WHERE id > ? ORDER BY id", (last_id,)).fetchall()
+                finally: conn.close()
+                if time.time() - last_renew > SSE_SUBSCRIBER_TTL_SECONDS / 3:
+                    with self.lock: self._register(list(self.subscribers))
+                    last_renew = time.time()
+                for r in rows:
+                    last_id = r['id']
+                    if r['node_id'] in self.subscribers: self._dispatch(r['node_id'], r['event'], json.loads(r['data']))
+            except Exception as e: print(f"SSE Poll Error: {e}", flush=True)
+            time.sleep(self.poll_interval)
+
+event_broker = EventBroker()
+
+def publish_status_change(device_id, before, after):
+    if after != before: event_broker.publish(device_id, "status", {"process_status": after})
+
+def publish_new_logs(c, device_id, template_id, after_id, new_count):
+    if not event_broker.has_subscribers(device_id, c): return
+    if new_count > SSE_MAX_DELTA_ROWS: event_broker.publish(device_id, "reset", {}); return
+    cutoff_time, _ = get_round_cutoff(c, device_id, template_id, datetime.now())
+    c.execute("SELECT id, log_time, nickname, item_type, quantity FROM logs WHERE id > ? AND device_id = ? AND template_id = ? AND log_ts >= ? ORDER BY id DESC",
+              (after_id, device_id, template_id, to_log_ts(cutoff_time)))
+    rows = [dict(r) for r in c.fetchall()]
+    if rows: event_broker.publish(device_id, "logs", {"template_id": template_id, "rows": rows})
+
+# 🔥 设备在线状态注册表：心跳只改内存，后台线程每隔几秒把有变化的设备批量写回 devices 表
+class PresenceRegistry:
+    FIELDS = ('device_id', 'nickname', 'last_seen', 'process_running', 'first_seen', 'password', 'template_id', 'last_msg', 'detected_template')
+
+    def __init__(self, flush_interval=PRESENCE_FLUSH_SECONDS):
+        self.lock = threading.Lock(); self.flush_interval = flush_interval
+        self.devices = None; self.dirty = set(); self.cursors = {}; self.flusher = None; self.last_cursor_prune = 0; self.last_sync = 0; self.last_pull = 0
+
+    def _ensure_loaded(self):
+        if self.devices is not None: return
+        conn = get_db_connection()
+        rows = conn.execute("SELECT * FROM devices").fetchall(); conn.close()
+        self.devices = {r['device_id']: {k: r[k] for k in self.FIELDS} for r in rows}
+        self.flusher = threading.Thread(target=self._flush_loop, name="presence-flusher", daemon=True); self.flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.time() - self.last_sync >= PRESENCE_SYNC_SECONDS: self.last_sync = time.time(); self.sync(); event_broker.prune(); self.prune_cursors()
+            except Exception as e: print(f"Presence Flush Error: {e}", flush=True)
+
+    def _pull_heartbeats(self):
+        """内存里的心跳快过期时（可能是别的 worker 收到了新心跳、还没等到下一次 sync），直接从库里拉最新的 last_seen。
+        库里的值最多落后 PRESENCE_FLUSH_SECONDS；每个进程每 PRESENCE_FLUSH_SECONDS 最多查一次"""
+        now = time.time()
+        with self.lock:
+            self._ensure_loaded()
+            if now - self.last_pull < self.flush_interval: return
+            if not any(now - (d['last_seen'] or 0) >= ONLINE_WINDOW_SECONDS - PRESENCE_SYNC_SECONDS for k, d in self.devices.items() if k not in self.dirty): return
+            self.last_pull = now
+        conn = get_db_connection()
+        try: rows = conn.execute("SELECT device_id, nickname, last_seen, process_running, password FROM devices WHERE last_seen > ?", (now - ONLINE_WINDOW_SECONDS,)).fetchall()
+        finally: conn.close()
+        with self.lock:
+            for r in rows:
+                dev = self.devices.get(r['device_id'])
+                if dev is not None and r['device_id'] not in self.dirty and r['last_seen'] > (dev['last_seen'] or 0):
+                    dev.update(nickname=r['nickname'], last_seen=r['last_seen'], process_running=r['process_running'], password=r['password'])
+
+    def sync(self):
+        """多 worker 部署时，其他进程的心跳 / 模板切换 / 删除节点只写到了库里，这里定期合并回内存"""
+        conn = get_db_connection()
+        rows = conn.execute("SELECT * FROM devices").fetchall(); conn.close()
+        with self.lock:
+            seen = set()
+            for r in rows:
+                device_id = r['device_id']; seen.add(device_id); dev = self.devices.get(device_id)
+                if dev is None: self.devices[device_id] = {k: r[k] for k in self.FIELDS}; continue
+                dev.update(template_id=r['template_id'], last_msg=r['last_msg'], detected_template=r['detected_template'])
+                if device_id not in self.dirty and (r['last_seen'] or 0) > (dev['last_seen'] or 0): dev.update({k: r[k] for k in self.FIELDS})
+            for device_id in [d for d in self.devices if d not in seen and d not in self.dirty]: del self.devices[device_id]
+            self.cursors.clear()
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty: return
+            rows = [tuple(self.devices[d][k] for k in self.FIELDS) for d in self.dirty if d in self.devices]; self.dirty = set()
+        conn = get_db_connection()
+        try:
+            # template_id / last_msg / detected_template 由各接口和解析进程直接写库，这里只写心跳字段
+            conn.executemany("""INSERT INTO devices (device_id, nickname, last_seen, process_running, first_seen, password, template_id, last_msg, detected_template) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                ON CONFLICT (device_id) DO UPDATE SET nickname = excluded.nickname, last_seen = excluded.last_seen, process_running = excluded.process_running, password = excluded.password""", rows)
+            conn.commit()
+        finally: conn.close()
+
+    def touch(self, device_id, nickname, process_running, password):
+        """记录一次心跳，返回 (之前的状态文字, 现在的状态文字)"""
+        self._pull_heartbeats(); now = time.time()
+        with self.lock:
+            dev = self.devices.get(device_id)
+            if dev is None:
+                before = None
+                dev = self.devices[device_id] = {'device_id': device_id, 'first_seen': now, 'template_id': 'default', 'last_msg': '正常', 'detected_template': ''}
+            else: before = device_status_text(dev['last_msg'], dev['last_seen'], dev['process_running'])
+            dev.update(nickname=nickname, last_seen=now, process_running=process_running, password=password)
+            self.dirty.add(device_id)
+            return before, device_status_text(dev['last_msg'], now, process_running)
+
+    def get(self, device_id):
+        self._pull_heartbeats()
+        with self.lock:
+            dev = self.devices.get(device_id)
+            return dict(dev) if dev else None
+
+    def all(self):
+        self._pull_heartbeats()
+        with self.lock:
+            return sorted((dict(d) for d in self.devices.values()), key=lambda d: d['first_seen'] or 0)
+
+    def template_of(self, device_id):
+        dev = self.get(device_id)
+        return dev['template_id'] if dev and dev['template_id'] else 'default'
+
+    def status_of(self, device_id):
+        dev = self.get(device_id)
+        return device_status_text(dev['last_msg'], dev['last_seen'], dev['process_running']) if dev else None
+
+    def update(self, device_id, **fields):
+        """同步已写入数据库的 template_id / last_msg / detected_template 到内存"""
+        with self.lock:
+            self._ensure_loaded()
+            if device_id in self.devices: self.devices[device_id].update(fields)
+
+    def remove(self, device_id):
+        with self.lock:
+            self._ensure_loaded()
+            self.devices.pop(device_id, None); self.dirty.discard(device_id)
+            for key in [k for k in self.cursors if k[0] == device_id]: del self.cursors[key]
+
+    def get_cursors(self, device_id, template_id):
+        key = (device_id, template_id)
+        with self.lock: cached = self.cursors.get(key)
+        if cached is None:
+            conn = get_db_connection(); cached = {r['file']: r for r in list_upload_cursors(conn.cursor(), device_id, template_id)}; conn.close()
+            with self.lock: self.cursors[key] = cached
+        return list(cached.values())
+
+    def prune_cursors(self):
+        if time.time() - self.last_cursor_prune < 3600: return
+        self.last_cursor_prune = time.time(); conn = get_db_connection()
+        try: conn.execute("DELETE FROM upload_cursors WHERE updated_at < ?", (time.time() - UPLOAD_CURSOR_TTL_SECONDS,)); conn.commit()
+        finally: conn.close()
+
+    def set_cursor(self, device_id, template_id, file_name, cursor):
+        with self.lock:
+            cached = self.cursors.get((device_id, template_id))
+            if cached is None: return
+            if cursor: cached[file_name] = cursor
+            else: cached.pop(file_name, None)
+
+presence = PresenceRegistry()
+atexit.register(lambda: presence.flush() if presence.devices is not None else None)
 
 def update_device_status(device_id, nickname, process_running, password):
-    conn = get_db_connection(); c = conn.cursor(); now = time.time()
-    c.execute("UPDATE devices SET nickname=?, last_seen=?, process_running=?, password=? WHERE device_id=?", (nickname, now, process_running, password, device_id))
-    if c.rowcount == 0: c.execute("INSERT INTO devices (device_id, nickname, last_seen, process_running, first_seen, password, template_id, last_msg, detected_template) VALUES (?, ?, ?, ?, ?, ?, 'default', '正常', '')", (device_id, nickname, now, process_running, now, password))
-    conn.commit(); conn.close()
+    return presence.touch(device_id, nickname, process_running, password)
+
+# 🔥 增量上传游标：记录每个 (设备, 模板, 文件) 已解析到的字节位置 + 文件头指纹，客户端只需上传新增尾部
+def get_upload_cursor(c, device_id, template_id, file_name):
+    c.execute("SELECT byte_offset, prefix_len, prefix_hash FROM upload_cursors WHERE device_id = ? AND template_id = ? AND file_name = ?", (device_id, template_id, file_name))
+    return c.fetchone()
+
+def list_upload_cursors(c, device_id, template_id):
+    """心跳下发的游标只含最近 UPLOAD_CURSOR_TTL_SECONDS 内上传过的文件；更早的文件客户端再传时按全量处理（unique_sign 去重）"""
+    c.execute("SELECT file_name, byte_offset, prefix_len, prefix_hash FROM upload_cursors WHERE device_id = ? AND template_id = ? AND updated_at >= ?",
+              (device_id, template_id, time.time() - UPLOAD_CURSOR_TTL_SECONDS))
+    return [{"file": r['file_name'], "offset": r['byte_offset'], "prefix_len": r['prefix_len'], "prefix_hash": r['prefix_hash']} for r in c.fetchall()]
+
+def save_upload_cursor(c, device_id, template_id, file_name, byte_offset, prefix_len, prefix_hash):
+    c.execute("REPLACE INTO upload_cursors (device_id, template_id, file_name, byte_offset, prefix_len, prefix_hash, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+              (device_id, template_id, file_name, byte_offset, prefix_len, prefix_hash, time.time()))
+
+def drop_upload_cursor(c, device_id, template_id, file_name):
+    c.execute("DELETE FROM upload_cursors WHERE device_id = ? AND template_id = ? AND file_name = ?", (device_id, template_id, file_name))
+
+def upload_encoding(stream):
+    """和整体 decode 一样选编码：整个流能按 gb18030 严格解码就用 gb18030，否则 utf-8。
+    先增量解码一遍只做校验（不留结果），再 seek 回起点，避免前面的块已经按 gb18030 乱码入库后才发现是 utf-8"""
+    start = stream.tell(); decoder = codecs.getincrementaldecoder('gb18030')()
+    try:
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk: break
+            decoder.decode(chunk)
+        decoder.decode(b'', final=True); encoding = 'gb18030'
+    except UnicodeDecodeError: encoding = 'utf-8'
+    stream.seek(start)
+    return encoding
+
+def iter_upload_lines(stream, info, complete_only=False):
+    """分块读取上传流并增量解码（编码由 upload_encoding 事先选定：gb18030，不行再 utf-8），逐行产出。
+    info 里回填总行数、最后一个完整行结束的字节位置和文件头字节（用于游标指纹）。"""
+    decoder = codecs.getincrementaldecoder(upload_encoding(stream))(errors='ignore')
+    head = b''; total = 0; rest = ''
+    info.update(lines=0, complete_len=0, head=b'')
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk: break
+        if len(head) < CURSOR_PREFIX_BYTES: head += chunk[:CURSOR_PREFIX_BYTES - len(head)]
+        nl = chunk.rfind(b'\n')
+        if nl >= 0: info['complete_len'] = total + nl + 1
+        total += len(chunk)
+        parts = (rest + decoder.decode(chunk)).split('\n'); rest = parts.pop()
+        info['lines'] += len(parts)
+        for line in parts: yield line
+    info['head'] = head
+    rest += decoder.decode(b'', final=True)
+    info['lines'] += 1
+    if not complete_only: yield rest
+
+def insert_log_batch(c, rows):
+    # rowcount 只统计真正插入的行（被 IGNORE 的重复行和触发器写入都不算）
+    rows = filter_archived(c, rows)
+    c.executemany("INSERT OR IGNORE INTO logs (log_time, nickname, item_type, quantity, unique_sign, device_id, template_id, log_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    return max(c.rowcount, 0)
+
+def ingest_upload(c, stream, device_id, template_id, complete_only=False):
+    """流式解析上传内容并按批 executemany 写入（调用方负责 commit），内存占用与文件大小无关。
+    前 DETECT_SAMPLE_LINES 个非空行留作样本，结束后给所有模板打分，识别结果放在 info['detected']"""
+    started = time.perf_counter(); info = {}
+    tpl = get_template(template_id); parse = tpl.parse; to_ts = None
+    matched = 0; inserted = 0; batch = []; sample = []
+    for line in iter_upload_lines(stream, info, complete_only):
+        line = line.strip()
+        if not line: continue
+        if len(sample) < DETECT_SAMPLE_LINES: sample.append(line)
+        parsed = parse(line)
+        if not parsed: continue
+        matched += 1
+        log_time, nick, item_type, quantity = parsed
+        if to_ts is None: to_ts = tpl.converter(log_time)
+        unique_sign = f"{log_time}_{nick}_{item_type}_{quantity}_{device_id}"
+        batch.append((log_time, nick, item_type, quantity, unique_sign, device_id, template_id, to_ts(log_time)))
+        if len(batch) >= INSERT_BATCH_SIZE: inserted += insert_log_batch(c, batch); batch = []
+    if batch: inserted += insert_log_batch(c, batch)
+    detected = detect_template(sample, template_id)
+    elapsed = time.perf_counter() - started
+    info.update(matched=matched, inserted=inserted, detected=detected, elapsed=elapsed, lines_per_sec=int(info['lines'] / elapsed) if elapsed > 0 else 0)
+    return info
+
+def current_log_seq(c):
+    c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'logs'"); row = c.fetchone()
+    return row['seq'] if row else 0
+
+def apply_ingest_result(c, device_id, template_id, result):
+    """解析结果写回设备（模板是否匹配、识别出的模板）并让 /api/stats 缓存失效，返回 (旧 last_msg, 新 last_msg)；调用方负责 commit"""
+    c.execute("SELECT last_msg FROM devices WHERE device_id = ?", (device_id,)); row = c.fetchone()
+    last_msg = "正常"
+    # 当前模板一行都没解析出来：行数较多，或者样本能被别的模板识别，就是模板选错了
+    if result['matched'] == 0 and (result['lines'] > 10 or result['detected']): last_msg = "模板错误"
+    # 样本里没有任何模板能识别的行（空包、半行）时保留上次的识别结果
+    c.execute("UPDATE devices SET last_msg = ?, detected_template = COALESCE(NULLIF(?, ''), detected_template) WHERE device_id = ?", (last_msg, result['detected'], device_id))
+    if result['inserted']: invalidate_stats(c, device_id)
+    return (row['last_msg'] if row else None), last_msg
+
+def next_upload_cursor(tail_offset, saved, tail_ok, complete_len, head):
+    """返回 (新游标, 是否要求全量重扫)"""
+    if tail_offset is None:
+        prefix_len = min(CURSOR_PREFIX_BYTES, complete_len)
+        return (complete_len, prefix_len, hashlib.sha1(head[:prefix_len]).hexdigest()), False
+    if tail_ok: return (tail_offset + complete_len, saved['prefix_len'], saved['prefix_hash']), False
+    # 游标对不上（文件轮转/截断/服务端丢失游标）：照常入库（unique_sign 去重兜底），并要求客户端下次全量重扫
+    return None, True
+
+# 🔥 磁盘队列（spool）：ready/ 里每个任务是一对文件 <job>.dat（原始上传内容）+ <job>.json（元数据，最后原子落盘）
+# 解析进程把 .json 改名到 work/ 即认领；入库提交后删除。崩溃/重启后 work/ 里的任务回到 ready/，重复解析由 unique_sign 去重
+def spool_path(*parts): return os.path.join(SPOOL_DIR, *parts)
+
+def spool_dirs():
+    for d in ('ready', 'work', 'failed', 'workers'): os.makedirs(spool_path(d), exist_ok=True)
+
+def durable_write(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f: f.write(data); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, path)
+    dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+    try: os.fsync(dir_fd)
+    finally: os.close(dir_fd)
+
+def spool_upload(stream, meta):
+    spool_dirs()
+    job = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+    head = b''; total = 0; complete_len = 0
+    with open(spool_path('ready', job + '.dat'), 'wb') as f:
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk: break
+            if len(head) < CURSOR_PREFIX_BYTES: head += chunk[:CURSOR_PREFIX_BYTES - len(head)]
+            nl = chunk.rfind(b'\n')
+            if nl >= 0: complete_len = total + nl + 1
+            total += len(chunk); f.write(chunk)
+        f.flush(); os.fsync(f.fileno())
+    durable_write(spool_path('ready', job + '.json'), json.dumps(dict(meta, job=job, size=total, queued_at=time.time()), ensure_ascii=False).encode('utf-8'))
+    return {"job": job, "complete_len": complete_len, "head": head}
+
+def claim_spool_jobs(worker_id, limit=SPOOL_BATCH_JOBS):
+    claimed = []
+    for name in sorted(n for n in os.listdir(spool_path('ready')) if n.endswith('.json')):
+        job = name[:-len('.json')]; target = spool_path('work', f"{job}.w{worker_id}.json")
+        try: os.rename(spool_path('ready', name), target)
+        except FileNotFoundError: continue  # 被其他解析进程抢先认领
+        claimed.append((job, target))
+        if len(claimed) >= limit: break
+    return claimed
+
+def recover_spool_claims(worker_id=None):
+    for name in os.listdir(spool_path('work')):
+        if worker_id is not None and not name.endswith(f".w{worker_id}.json"): continue
+        os.replace(spool_path('work', name), spool_path('ready', name.split('.', 1)[0] + '.json'))
+
+def finish_spool_job(job, meta_path, failed=False):
+    if failed:
+        os.replace(meta_path, spool_path('failed', job + '.json'))
+        if os.path.exists(spool_path('ready', job + '.dat')): os.replace(spool_path('ready', job + '.dat'), spool_path('failed', job + '.dat'))
+        return
+    try: os.remove(spool_path('ready', job + '.dat'))
+    except FileNotFoundError: pass
+    os.remove(meta_path)
+
+def drop_failed_job_cursor(meta_path):
+    """上传排队时游标已经推进，客户端不会再发这段内容；任务失败就删掉该文件的游标，下次心跳让客户端全量重扫（重复行由 unique_sign 去重）"""
+    try:
+        with open(meta_path, encoding='utf-8') as f: meta = json.load(f)
+        conn = get_db_connection()
+        try: drop_upload_cursor(conn.cursor(), meta['device_id'], meta['template_id'], meta.get('file_name', '')); conn.commit()
+        finally: conn.close()
+    except Exception as e: print(f"Spool Cursor Error: {meta_path} {e}", flush=True)
+
+def spool_supervisor_alive():
+    try: return time.time() - os.path.getmtime(spool_path('supervisor.json')) < SPOOL_SUPERVISOR_STALE_SECONDS
+    except OSError: return False
+
+def process_spool_jobs(jobs, stats):
+    """一批任务在一个事务里入库；整批失败时逐个重试，单个仍失败的移到 failed/"""
+    started = time.perf_counter(); conn = get_db_connection(); c = conn.cursor(); done = []
+    try:
+        last_id = current_log_seq(c)
+        for job, meta_path in jobs:
+            with open(meta_path, encoding='utf-8') as f: meta = json.load(f)
+            with open(spool_path('ready', job + '.dat'), 'rb') as f:
+                result = ingest_upload(c, f, meta['device_id'], meta['template_id'], complete_only=meta.get('complete_only', False))
+            done.append((meta, result, apply_ingest_result(c, meta['device_id'], meta['template_id'], result)))
+        conn.commit()
+    except Exception as e:
+        conn.close()
+        if len(jobs) > 1:
+            for one in jobs: process_spool_jobs([one], stats)
+        else:
+            print(f"Spool Job Error: {jobs[0][0]} {e}", flush=True); drop_failed_job_cursor(jobs[0][1]); finish_spool_job(*jobs[0], failed=True); stats['failed'] += 1
+        return
+    inserted = {}
+    for meta, result, (old_msg, new_msg) in done:
+        key = (meta['device_id'], meta['template_id']); inserted[key] = inserted.get(key, 0) + result['inserted']
+        stats['lines'] += result['lines']; stats['inserted'] += result['inserted']; record_ingest(meta['template_id'], result)
+        if old_msg != new_msg:
+            row = c.execute("SELECT last_msg, last_seen, process_running FROM devices WHERE device_id = ?", (meta['device_id'],)).fetchone()
+            if row: event_broker.publish(meta['device_id'], "status", {"process_status": device_status_text(row['last_msg'], row['last_seen'], row['process_running'])})
+    for (device_id, template_id), new_count in inserted.items():
+        if new_count: publish_new_logs(c, device_id, template_id, last_id, new_count)
+    conn.close()
+    for job, meta_path in jobs: finish_spool_job(job, meta_path)
+    stats['jobs'] += len(jobs); stats['busy_seconds'] += time.perf_counter() - started
+
+def write_worker_stats(worker_id, stats):
+    busy = stats['busy_seconds']
+    durable = dict(stats, worker_id=worker_id, pid=os.getpid(), updated_at=time.time(), lines_per_sec=int(stats['lines'] / busy) if busy > 0 else 0)
+    tmp = spool_path('workers', f"{worker_id}.json.tmp")
+    with open(tmp, 'w', encoding='utf-8') as f: json.dump(durable, f)
+    os.replace(tmp, spool_path('workers', f"{worker_id}.json"))
+
+def ingest_worker_main(worker_id):
+    stats = {"jobs": 0, "lines": 0, "inserted": 0, "failed": 0, "busy_seconds": 0.0}
+    write_worker_stats(worker_id, stats)
+    while True:
+        jobs = claim_spool_jobs(worker_id)
+        if not jobs: time.sleep(SPOOL_POLL_SECONDS); continue
+        process_spool_jobs(jobs, stats); write_worker_stats(worker_id, stats); metrics.flush()
+
+def run_ingest_workers(count=INGEST_WORKERS):
+    """解析进程池的守护循环：启动时回收上次没做完的任务，子进程退出后回收它认领的任务并重启。同一个 spool 目录只能跑一个"""
+    spool_dirs(); recover_spool_claims(); procs = {}
+    while True:
+        for i in range(count):
+            p = procs.get(i)
+            if p is None or not p.is_alive():
+                if p is not None: print(f"Ingest worker {i} exited ({p.exitcode}), restarting", flush=True); recover_spool_claims(i)
+                procs[i] = multiprocessing.Process(target=ingest_worker_main, args=(i,), name=f"ingest-worker-{i}", daemon=True); procs[i].start()
+        # web 进程据此判断有没有进程池在消费队列
+        tmp = spool_path('supervisor.json.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f: json.dump({"pid": os.getpid(), "workers": count, "updated_at": time.time()}, f)
+        os.replace(tmp, spool_path('supervisor.json'))
+        time.sleep(2)
 
 @app.route('/manifest.json')
 def serve_manifest(): return send_from_directory('static', 'manifest.json', mimetype='application/json')
@@ -125,11 +1270,8 @@ def dashboard(): return render_template('dashboard.html')
 
 @app.route('/api/nodes')
 def get_nodes():
-    conn = get_db_connection(); c = conn.cursor()
-    c.execute("SELECT * FROM devices ORDER BY first_seen ASC"); rows = c.fetchall()
     nodes = []; now = time.time()
-    for r in rows: nodes.append({ "device_id": r['device_id'], "nickname": r['nickname'], "is_online": (now - r['last_seen']) < 15, "process_running": bool(r['process_running']), "has_password": bool(r['password']), "template_id": r['template_id'] })
-    conn.close()
+    for r in presence.all(): nodes.append({ "device_id": r['device_id'], "nickname": r['nickname'], "is_online": (now - r['last_seen']) < ONLINE_WINDOW_SECONDS, "process_running": bool(r['process_running']), "has_password": bool(r['password']), "template_id": r['template_id'] })
     return jsonify({"nodes": nodes})
 
 @app.route('/api/node/delete', methods=['POST'])
@@ -137,7 +1279,7 @@ def delete_node():
     device_id = request.json.get('device_id')
     if not device_id: return jsonify({"status": "error"}), 400
     conn = get_db_connection()
-    try: conn.execute("DELETE FROM devices WHERE device_id = ?", (device_id,)); conn.commit(); return jsonify({"status": "success"})
+    try: presence.remove(device_id); conn.execute("DELETE FROM devices WHERE device_id = ?", (device_id,)); conn.commit(); return jsonify({"status": "success"})
     except Exception as e: return jsonify({"error": str(e)}), 500
     finally: conn.close()
 
@@ -145,13 +1287,11 @@ def delete_node():
 def reset_round():
     device_id = request.json.get('device_id')
     if not device_id: return jsonify({"status": "error"}), 400
-    conn = get_db_connection(); c = conn.cursor()
-    c.execute("SELECT template_id FROM devices WHERE device_id = ?", (device_id,))
-    row = c.fetchone(); conn.close()
-    template_id = row['template_id'] if row and row['template_id'] else 'default'
-    key = f"{device_id}_{template_id}"
+    template_id = presence.template_of(device_id)
     now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    round_start_times[key] = now_str; save_round_times(round_start_times)
+    conn = get_db_connection(); c = conn.cursor()
+    save_round_start(c, device_id, template_id, now_str); invalidate_stats(c, device_id); conn.commit(); conn.close()
+    event_broker.publish(device_id, "reset", {"round_start_time": now_str})
     return jsonify({"status": "success", "round_start_time": now_str})
 
 @app.route('/api/templates', methods=['GET'])
@@ -164,24 +1304,25 @@ def set_template():
     data = request.json
     device_id = data.get('node_id'); template_id = data.get('template_id')
     if not device_id or not template_id: return jsonify({"error": "Missing params"}), 400
-    conn = get_db_connection()
-    conn.execute("UPDATE devices SET template_id = ?, last_msg = '正常' WHERE device_id = ?", (template_id, device_id))
-    conn.commit(); conn.close()
+    conn = get_db_connection(); c = conn.cursor()
+    c.execute("UPDATE devices SET template_id = ?, last_msg = '正常' WHERE device_id = ?", (template_id, device_id))
+    invalidate_stats(c, device_id); conn.commit(); conn.close(); presence.update(device_id, template_id=template_id, last_msg='正常')
+    event_broker.publish(device_id, "reset", {"template_id": template_id})
     return jsonify({"status": "success"})
 
 @app.route('/api/history_logs')
 def get_history_logs():
     target_node_id = request.args.get('node_id'); target_date = request.args.get('date') 
     if not target_node_id or not target_date: return jsonify({"logs": []})
+    # 可选分页：limit + before_id / after_id；format=columns 返回列式编码。不带 limit 时整天一次返回
+    before_id, after_id, limit, columnar = page_args(None)
     conn = get_db_connection(); c = conn.cursor()
     try:
-        c.execute("SELECT template_id FROM devices WHERE device_id = ?", (target_node_id,))
-        row = c.fetchone()
-        template_id = row['template_id'] if row and row['template_id'] else 'default'
-        target_date_slash = target_date.replace('-', '/')
-        c.execute("SELECT log_time, nickname, item_type, quantity FROM logs WHERE device_id = ? AND template_id = ? AND (log_time LIKE ? OR log_time LIKE ?) ORDER BY id DESC", 
-                  (target_node_id, template_id, f"{target_date}%", f"{target_date_slash}%"))
-        return jsonify({"logs": [dict(row) for row in c.fetchall()]})
+        template_id = presence.template_of(target_node_id)
+        # 历史页日期已统一为 YYYY-MM-DD，按 log_ts 的整天区间查询，兼容所有日志日期格式
+        day_ts = to_log_ts(datetime.strptime(target_date, '%Y-%m-%d'))
+        rows, has_more = query_log_page(c, 'history_logs', target_node_id, template_id, day_ts, day_ts + DAY_SECONDS, before_id, after_id, limit)
+        return jsonify(log_page_payload("logs", rows, has_more, columnar))
     except: return jsonify({"logs": []})
     finally: conn.close()
 
@@ -191,16 +1332,34 @@ def heartbeat():
     device_id = data.get('device_id'); nickname = data.get('nickname', 'Unknown'); password = data.get('password', '')
     process_running = 1 if data.get('process_running', False) else 0
     if not device_id: return jsonify({"status": "error"}), 400
+    metrics.inc("lot_heartbeats_total")
     try:
-        update_device_status(device_id, nickname, process_running, password)
-        conn = get_db_connection(); c = conn.cursor()
-        c.execute("SELECT template_id FROM devices WHERE device_id = ?", (device_id,))
-        row = c.fetchone(); conn.close()
-        template_id = row['template_id'] if row and row['template_id'] else 'default'
+        # 心跳完全走内存注册表，不再每次写库
+        before, after = update_device_status(device_id, nickname, process_running, password)
+        publish_status_change(device_id, before, after)
+        template_id = presence.template_of(device_id); cursors = presence.get_cursors(device_id, template_id)
         parser = LOG_PARSERS.get(template_id, LOG_PARSERS['default'])
-        return jsonify({ "status": "ok", "file_rule": parser.get("file_rule", "lot.txt"), "folder_rule": parser.get("folder_rule", "") })
+        return jsonify({ "status": "ok", "file_rule": parser.get("file_rule", "lot.txt"), "folder_rule": parser.get("folder_rule", ""), "cursors": cursors })
     except Exception as e: return jsonify({"error": str(e)}), 500
 
+@app.route('/api/stream')
+def stream_events():
+    node_id = request.args.get('node_id'); req_password = request.args.get('password', '')
+    if not node_id: return jsonify({"status": "error"}), 400
+    dev = presence.get(node_id)
+    if dev and dev['password'] and dev['password'] != req_password: return jsonify({"error": "auth_failed"}), 403
+    q = event_broker.subscribe(node_id)
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try: event, data = q.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty: yield ": keepalive\n\n"; continue
+                yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        finally: event_broker.unsubscribe(node_id, q)
+    return Response(generate(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route('/api/health', methods=['GET'])
 def health_check(): return jsonify({"status": "online", "server": "LittlePilot"})
 
@@ -210,12 +1369,10 @@ def update_history():
     device_id = data.get('device_id')
     conn = get_db_connection()
     try:
-        c = conn.cursor()
-        c.execute("SELECT template_id FROM devices WHERE device_id = ?", (device_id,))
-        row = c.fetchone()
-        template_id = row['template_id'] if row and row['template_id'] else 'default'
+        c = conn.cursor(); template_id = presence.template_of(device_id)
         c.execute("REPLACE INTO daily_overrides (date, device_id, template_id, manual_users, manual_sum) VALUES (?, ?, ?, ?, ?)", (data.get('date'), device_id, template_id, data.get('manual_users'), data.get('manual_sum')))
-        conn.commit(); return jsonify({"status": "success"})
+        invalidate_stats(c, device_id); conn.commit(); event_broker.publish(device_id, "reset", {})
+        return jsonify({"status": "success"})
     except Exception as e: return jsonify({"status": "error", "msg": str(e)}), 500
     finally: conn.close()
 
@@ -226,8 +1383,7 @@ def get_user_total():
     if not target_node_id: return jsonify({"error": "Missing node_id"}), 400
     conn = get_db_connection(); c = conn.cursor()
     try:
-        c.execute("SELECT template_id FROM devices WHERE device_id = ?", (target_node_id,))
-        row = c.fetchone(); template_id = row['template_id'] if row and row['template_id'] else 'default'
+        template_id = presence.template_of(target_node_id)
         start_dt = datetime.min; end_dt = datetime.max
         if start_date:
             start_str = start_date.replace('T', ' ')
@@ -240,28 +1396,18 @@ def get_user_total():
             elif len(end_str) == 16: end_str += ":59"
             end_dt = datetime.strptime(end_str, "%Y-%m-%d %H:%M:%S")
 
+        # 区间求和走 daily_rollups（首尾不满一天的部分回查 logs 的 log_ts 索引）
+        start_ts = to_log_ts(start_dt) if start_date else None; end_ts = to_log_ts(end_dt) if end_date else None
+
         if calc_all == '1':
-            c.execute("SELECT log_time, quantity FROM logs WHERE device_id = ? AND template_id = ?", (target_node_id, template_id))
-            rows = c.fetchall(); total = 0
-            for r in rows:
-                log_dt = parse_log_date(r['log_time'])
-                if log_dt and start_dt <= log_dt <= end_dt: total += r['quantity']
-            return jsonify({"total": total})
+            totals = query_rollup_range(c, target_node_id, template_id, start_ts, end_ts, query_name='user_total_all')
+            return jsonify({"total": sum(v[1] for v in totals.values())})
         elif not nickname:
-            c.execute("SELECT DISTINCT nickname FROM logs WHERE device_id = ? AND template_id = ?", (target_node_id, template_id))
-            return jsonify({"users": [r['nickname'] for r in c.fetchall() if r['nickname']]})
+            rows = fetch_all(c, 'user_total_users', "SELECT DISTINCT nickname FROM daily_rollups WHERE device_id = ? AND template_id = ?", (target_node_id, template_id))
+            return jsonify({"users": [r['nickname'] for r in rows if r['nickname']]})
         else:
-            if start_date or end_date:
-                c.execute("SELECT log_time, quantity FROM logs WHERE device_id = ? AND nickname = ? AND template_id = ?", (target_node_id, nickname, template_id))
-                rows = c.fetchall(); total = 0
-                for r in rows:
-                    log_dt = parse_log_date(r['log_time'])
-                    if log_dt and start_dt <= log_dt <= end_dt: total += r['quantity']
-                return jsonify({"total": total})
-            else:
-                c.execute("SELECT SUM(quantity) as total FROM logs WHERE device_id = ? AND nickname = ? AND template_id = ?", (target_node_id, nickname, template_id))
-                r = c.fetchone()
-                return jsonify({"total": r['total'] if r['total'] else 0})
+            totals = query_rollup_range(c, target_node_id, template_id, start_ts, end_ts, nickname=nickname, query_name='user_total_nickname')
+            return jsonify({"total": sum(v[1] for v in totals.values())})
     except Exception as e: return jsonify({"error": str(e)}), 500
     finally: conn.close()
 
@@ -272,129 +1418,159 @@ def upload_file():
     nickname = request.form.get('nickname', 'Unknown'); password = request.form.get('password', '')
     process_running = 1 if request.form.get('process_running', 'False') == 'True' else 0
     client_template = request.form.get('template_id', 'default')
+    # 增量模式：客户端带上 offset + prefix_hash 时，file 只包含该偏移之后的新增内容
+    tail_offset = request.form.get('offset', type=int); tail_hash = request.form.get('prefix_hash', '')
     
     if not file or not device_id: return jsonify({"status": "error"}), 400
-    update_device_status(device_id, nickname, process_running, password)
+    file_name = os.path.basename(request.form.get('file_name') or file.filename or 'lot.txt')
+    before, _ = update_device_status(device_id, nickname, process_running, password)
     
-    conn = get_db_connection(); c = conn.cursor()
-    parser = LOG_PARSERS.get(client_template, LOG_PARSERS['default'])
-    pattern = parser['pattern']
-    
-    raw_data = file.read()
-    try: content = raw_data.decode('gb18030')
-    except: content = raw_data.decode('utf-8', errors='ignore')
-    lines = content.split('\n')
+    if before is None: presence.flush()  # 新设备先落库，保证下面的 UPDATE devices 能命中
     
-    new_count = 0; total_matched = 0
-    for line in lines:
-        line = line.strip()
-        if not line: continue 
-        match = re.search(pattern, line)
-        if match:
-            total_matched += 1
-            if client_template == 'pixiu':
-                log_time_raw, nick, raw_val = match.groups()
-                log_time = log_time_raw.replace('年', '-').replace('月', '-').replace('日', '').replace('时', ':').replace('分', ':').replace('秒', '')
-                if '钻' in raw_val:
-                    q_match = re.search(r'\d+', raw_val)
-                    quantity = int(q_match.group()) if q_match else 1
-                    final_item_type = "钻石"
-                else:
-                    final_item_type = raw_val
-                    quantity = 1
-            else:
-                log_time, nick, q_str = match.group(1), match.group(2), match.group(3)
-                quantity = int(q_str)
-                final_item_type = parser['item_type']
-            
-            unique_sign = f"{log_time}_{nick}_{final_item_type}_{quantity}_{device_id}" 
-            try:
-                c.execute("INSERT INTO logs (log_time, nickname, item_type, quantity, unique_sign, device_id, template_id) VALUES (?, ?, ?, ?, ?, ?, ?)", 
-                          (log_time, nick, final_item_type, quantity, unique_sign, device_id, client_template))
-                new_count += 1
-            except sqlite3.IntegrityError: pass 
-            
-    last_msg = "正常"
-    if len(lines) > 10 and total_matched == 0: last_msg = "模板错误"
-    c.execute("UPDATE devices SET last_msg = ?, detected_template = ? WHERE device_id = ?", (last_msg, client_template, device_id))
-    conn.commit(); conn.close()
-    return jsonify({"status": "success", "new_entries": new_count})
+    conn = get_db_connection(); c = conn.cursor()
+    saved = get_upload_cursor(c, device_id, client_template, file_name) if tail_offset is not None else None
+    tail_ok = bool(saved) and saved['byte_offset'] == tail_offset and saved['prefix_hash'] == tail_hash
+    # 不管全量还是尾部上传都只解析到最后一个完整行：下发的游标停在半行之前（游标对不上时则要求全量重扫），半行写完后随下次上传入库，不会同一行入库两次
+
+    spool = INGEST_MODE == 'spool' and spool_supervisor_alive()
+    if INGEST_MODE == 'spool' and not spool: warn_no_supervisor()
+    if spool:
+        # 只落盘排队，立即返回 202；游标照常推进，数据由解析进程池入库
+        queued = spool_upload(file.stream, {"device_id": device_id, "template_id": client_template, "file_name": file_name, "complete_only": True})
+        cursor, rescan = next_upload_cursor(tail_offset, saved, tail_ok, queued['complete_len'], queued['head'])
+        if cursor: save_upload_cursor(c, device_id, client_template, file_name, *cursor)
+        else: drop_upload_cursor(c, device_id, client_template, file_name)
+        conn.commit(); conn.close()
+        presence.set_cursor(device_id, client_template, file_name, {"file": file_name, "offset": cursor[0], "prefix_len": cursor[1], "prefix_hash": cursor[2]} if cursor else None)
+        return jsonify({"status": "queued", "job": queued['job'], "rescan": rescan,
+                        "cursor": {"file": file_name, "offset": cursor[0], "prefix_len": cursor[1], "prefix_hash": cursor[2]} if cursor else None}), 202
+
+    last_id = current_log_seq(c)
+    result = ingest_upload(c, file.stream, device_id, client_template, complete_only=True)
+    cursor, rescan = next_upload_cursor(tail_offset, saved, tail_ok, result['complete_len'], result['head'])
+    new_count = result['inserted']
+    _, last_msg = apply_ingest_result(c, device_id, client_template, result)
+    if cursor: save_upload_cursor(c, device_id, client_template, file_name, *cursor)
+    else: drop_upload_cursor(c, device_id, client_template, file_name)
+    conn.commit(); record_ingest(client_template, result)
+    presence.update(device_id, last_msg=last_msg)
+    if result['detected']: presence.update(device_id, detected_template=result['detected'])
+    presence.set_cursor(device_id, client_template, file_name, {"file": file_name, "offset": cursor[0], "prefix_len": cursor[1], "prefix_hash": cursor[2]} if cursor else None)
+    publish_status_change(device_id, before, presence.status_of(device_id))
+    if new_count: publish_new_logs(c, device_id, client_template, last_id, new_count)
+    conn.close()
+    return jsonify({"status": "success", "new_entries": new_count, "rescan": rescan, "lines": result['lines'], "lines_per_sec": result['lines_per_sec'],
+                    "cursor": {"file": file_name, "offset": cursor[0], "prefix_len": cursor[1], "prefix_hash": cursor[2]} if cursor else None})
+
+no_supervisor_warned_at = 0
+
+def warn_no_supervisor():
+    global no_supervisor_warned_at
+    if time.time() - no_supervisor_warned_at < 60: return
+    no_supervisor_warned_at = time.time()
+    print("Spool Warning: INGEST_MODE=spool but no ingest-workers supervisor is running, ingesting uploads inline", flush=True)
+
+@app.route('/api/ingest_status')
+def ingest_status():
+    """spool 队列深度、积压时长和各解析进程的吞吐"""
+    if not os.path.isdir(spool_path('ready')): return jsonify({"mode": INGEST_MODE, "supervisor_alive": False, "queue_depth": 0, "queued_bytes": 0, "lag_seconds": 0, "in_progress": 0, "failed": 0, "workers": []})
+    ready = sorted(n[:-len('.json')] for n in os.listdir(spool_path('ready')) if n.endswith('.json'))
+    queued_bytes = 0
+    for job in ready:
+        try: queued_bytes += os.path.getsize(spool_path('ready', job + '.dat'))
+        except OSError: pass
+    lag = max(0.0, time.time() - int(ready[0].split('-')[0]) / 1e9) if ready else 0
+    workers = []
+    for name in sorted(os.listdir(spool_path('workers'))):
+        if not name.endswith('.json'): continue
+        try:
+            with open(spool_path('workers', name), encoding='utf-8') as f: workers.append(json.load(f))
+        except (OSError, ValueError): pass
+    return jsonify({"mode": INGEST_MODE, "supervisor_alive": spool_supervisor_alive(), "queue_depth": len(ready), "queued_bytes": queued_bytes, "lag_seconds": round(lag, 3),
+                    "in_progress": len([n for n in os.listdir(spool_path('work')) if n.endswith('.json')]),
+                    "failed": len([n for n in os.listdir(spool_path('failed')) if n.endswith('.json')]), "workers": workers})
+
+@app.route('/api/metrics')
+def get_metrics():
+    """Prometheus 文本格式；计数器和直方图是所有进程之和，设备数按本进程的注册表计算"""
+    counters, histograms = metrics.collect(); now = time.time(); devices = presence.all()
+    counters[("lot_devices_online", ())] = sum(1 for r in devices if now - (r['last_seen'] or 0) < ONLINE_WINDOW_SECONDS)
+    counters[("lot_devices_total", ())] = len(devices)
+    series = {}
+    for (name, labels), v in sorted(counters.items()): series.setdefault(name, []).append(f"{name}{prom_labels(labels)} {v}")
+    for (name, labels), h in sorted(histograms.items()):
+        out = series.setdefault(name, []); cumulative = 0
+        for le, n in zip(LATENCY_BUCKETS + ('+Inf',), h[:-2]):
+            cumulative += n; out.append(f"{name}_bucket{prom_labels(labels + (('le', str(le)),))} {cumulative}")
+        out.append(f"{name}_sum{prom_labels(labels)} {h[-2]:.6f}"); out.append(f"{name}_count{prom_labels(labels)} {h[-1]}")
+    lines = []
+    for name in sorted(series):
+        kind, help_text = METRIC_HELP.get(name, ("untyped", name))
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"] + series[name]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
 
 @app.route('/api/stats')
 def get_stats():
     target_node_id = request.args.get('node_id'); req_password = request.args.get('password', '')
-    conn = get_db_connection(); c = conn.cursor()
+    # 页大小取整到 DETAILS_LIMIT_STEPS 里不小于请求值的一档，缓存里每个节点最多这几份
+    details_limit = DETAILS_LIMIT_STEPS[bisect.bisect_left(DETAILS_LIMIT_STEPS, max(0, min(request.args.get('details_limit', DETAILS_PAGE_MAX, type=int), DETAILS_PAGE_MAX)))]
+    conn = get_db_connection(); c = conn.cursor(); signature = None
     try:
         process_status_text = "未连接"; current_template = "default"; detected_template = ""
         if target_node_id:
-            try:
-                c.execute("SELECT last_seen, process_running, password, template_id, last_msg, detected_template FROM devices WHERE device_id = ?", (target_node_id,))
-                row = c.fetchone()
-                if row:
-                    if row['password'] and row['password'] != req_password:
-                        conn.close(); return jsonify({"error": "auth_failed"}), 403
-                    current_template = row['template_id']; detected_template = row['detected_template'] if row['detected_template'] else ""
-                    if row['last_msg'] == "模板错误": process_status_text = "模板错误"
-                    else:
-                        if (time.time() - row['last_seen']) >= 15: process_status_text = "离线" 
-                        elif row['process_running']: process_status_text = "运行中"
-                        else: process_status_text = "未运行"
-                else: process_status_text = "未知设备"
-            except sqlite3.OperationalError: process_status_text = "数据异常"
+            row = presence.get(target_node_id)
+            if row:
+                if row['password'] and row['password'] != req_password:
+                    conn.close(); return jsonify({"error": "auth_failed"}), 403
+                current_template = row['template_id']; detected_template = row['detected_template'] if row['detected_template'] else ""
+                process_status_text = device_status_text(row['last_msg'], row['last_seen'], row['process_running'])
+            else: process_status_text = "未知设备"
         else: process_status_text = "请选择节点"
 
-        # 🔥 数据源里加入了 item_type 用于实物判断
-        query = "SELECT id, log_time, nickname, quantity, item_type FROM logs WHERE device_id = ? AND template_id = ?"
-        c.execute(query, (target_node_id, current_template))
-        all_raw_logs = [dict(row) for row in c.fetchall()]
-
         now = datetime.now()
-        base_cutoff = now - timedelta(hours=48); cutoff_time = base_cutoff
-        
-        key = f"{target_node_id}_{current_template}"
-        if key in round_start_times:
-            try: cutoff_time = max(base_cutoff, datetime.strptime(round_start_times[key], '%Y-%m-%d %H:%M:%S'))
-            except: pass
-        elif target_node_id in round_start_times:
-            try: cutoff_time = max(base_cutoff, datetime.strptime(round_start_times[target_node_id], '%Y-%m-%d %H:%M:%S'))
-            except: pass
-
-        overview_logs = []
-        for log in all_raw_logs:
-            log_dt = parse_log_date(log['log_time'])
-            if log_dt and log_dt >= cutoff_time: 
-                overview_logs.append({ "nickname": log['nickname'], "quantity": log['quantity'], "item_type": log['item_type'], "log_dt": log_dt })
-
-        total_users = len(set(l['nickname'] for l in overview_logs))
+        cutoff_time, round_start = get_round_cutoff(c, target_node_id, current_template, now)
+        if target_node_id:
+            cache_key = (target_node_id, current_template, details_limit)
+            signature = (process_status_text, detected_template, round_start, cutoff_time, now.strftime('%Y-%m-%d'), get_stats_version(c, target_node_id))
+            cached = stats_cache.get(cache_key)
+            if cached and cached[0] == signature:
+                conn.close(); return stats_response(cached[1], cached[2])
+
+        cutoff_ts = to_log_ts(cutoff_time)
+
+        # 🔥 按 (nickname, item_type) 汇总：整天走 daily_rollups，不满一天的部分才查 logs
+        overview = query_rollup_range(c, target_node_id, current_template, start_ts=cutoff_ts, query_name='stats_overview')
+
         # 🔥 计算钻石和实物的区分
-        total_wins = sum(l['quantity'] for l in overview_logs if l.get('item_type') == '钻石')
-        total_physical_wins = sum(l['quantity'] for l in overview_logs if l.get('item_type') != '钻石')
+        total_wins = sum(v[1] for (nick, item_type), v in overview.items() if item_type == '钻石')
+        total_physical_wins = sum(v[1] for (nick, item_type), v in overview.items() if item_type != '钻石')
         
         rank_map = {}
-        for l in overview_logs:
-            if l['nickname'] not in rank_map: rank_map[l['nickname']] = {"win_times": 0, "win_sum": 0}
-            rank_map[l['nickname']]["win_times"] += 1; rank_map[l['nickname']]["win_sum"] += l['quantity']
+        for (nick, item_type), (win_times, win_sum) in overview.items():
+            if nick not in rank_map: rank_map[nick] = {"win_times": 0, "win_sum": 0}
+            rank_map[nick]["win_times"] += win_times; rank_map[nick]["win_sum"] += win_sum
+        total_users = len(rank_map)
         
         rank_list = [{"nickname": k, "win_times": v["win_times"], "win_sum": v["win_sum"]} for k, v in rank_map.items()]
         rank_list.sort(key=lambda x: x['win_sum'], reverse=True)
 
         date_range_str = f"{cutoff_time.strftime('%m-%d %H:%M')} - 至今"
-        if not overview_logs: date_range_str = "暂无数据"
-
-        query_det = "SELECT id, log_time, nickname, item_type, quantity FROM logs WHERE device_id = ? AND template_id = ? ORDER BY id DESC LIMIT 5000"
-        c.execute(query_det, (target_node_id, current_template))
-        details = [log for log in [dict(row) for row in c.fetchall()] if parse_log_date(log['log_time']) and parse_log_date(log['log_time']) >= cutoff_time]
-
-        hist_sql = '''SELECT substr(l.log_time, 1, 10) as date_str, COUNT(DISTINCT l.nickname) as calc_users, SUM(l.quantity) as calc_sum, d.manual_users, d.manual_sum 
-                      FROM logs l 
-                      LEFT JOIN daily_overrides d ON substr(l.log_time, 1, 10) = d.date AND d.device_id = l.device_id AND d.template_id = l.template_id
-                      WHERE l.device_id = ? AND l.template_id = ?
-                      GROUP BY date_str'''
-        c.execute(hist_sql, (target_node_id, current_template))
+        if not overview: date_range_str = "暂无数据"
+
+        # 明细只带第一页（details_limit 行），更早的由 /api/details 按 before_id 翻页
+        details, details_has_more = query_log_page(c, 'stats_details', target_node_id, current_template, cutoff_ts, limit=details_limit) if details_limit else ([], False)
+        details = encode_log_rows(details)
+
+        hist_sql = '''SELECT r.day as date_str, COUNT(DISTINCT r.nickname) as calc_users, SUM(r.win_sum) as calc_sum, d.manual_users, d.manual_sum 
+                      FROM daily_rollups r 
+                      LEFT JOIN daily_overrides d ON r.day = d.date AND d.device_id = r.device_id AND d.template_id = r.template_id
+                      WHERE r.device_id = ? AND r.template_id = ?
+                      GROUP BY r.day'''
+        history_rows = fetch_all(c, 'stats_history', hist_sql, (target_node_id, current_template))
         
         history_list = []
         today_strs = (now.strftime('%Y-%m-%d'), now.strftime('%Y/%m/%d'), now.strftime('%Y.%m.%d'))
-        for row in c.fetchall():
+        for row in history_rows:
             if row['date_str'] in today_strs: continue
             final_users = row['manual_users'] if row['manual_users'] is not None else row['calc_users']
             final_sum = row['manual_sum'] if row['manual_sum'] is not None else row['calc_sum']
@@ -404,16 +1580,191 @@ def get_stats():
 
     except Exception as e:
         print(f"Stats Error: {e}", flush=True)
-        process_status_text, total_users, total_wins, total_physical_wins, rank_list, details, history_list = "Error", 0, 0, 0, [], [], []
+        process_status_text, total_users, total_wins, total_physical_wins, rank_list, details, history_list = "Error", 0, 0, 0, [], [], []; details_has_more = False
         current_template, detected_template = "default", ""
-        date_range_str = "Error"
+        date_range_str = "Error"; signature = None
     
     conn.close()
-    return jsonify({
+    body = app.json.dumps({
         "process_status": process_status_text, "current_template": current_template, "detected_template": detected_template,
         "total_users": total_users, "total_wins": total_wins, "total_physical_wins": total_physical_wins, 
-        "rank_list": rank_list, "date_range": date_range_str, "details": details, "history_data": history_list
+        "rank_list": rank_list, "date_range": date_range_str, "details": details, "details_has_more": details_has_more, "history_data": history_list
     })
+    etag = hashlib.md5(body.encode('utf-8')).hexdigest()
+    if signature: stats_cache[cache_key] = (signature, body, etag)
+    return stats_response(body, etag)
+
+# 🔥 /api/fleet_stats：每个进程缓存各节点本轮的按用户汇总。首次（以及节点换模板/重置轮次时）用一条分组查询建好，
+# 之后每次只按 id 取新增的行、按 log_ts 取滑出 48 小时窗口的行做加减，300 个节点也不用每次重新汇总
+class FleetAggregate:
+    def __init__(self): self.lock = threading.Lock(); self.nodes = {}; self.last_id = None; self.floor_ts = None
+
+    def _build(self, c, specs):
+        """specs: [(device_id, template_id, cutoff_ts)]，第一个完整天起走 daily_rollups，之前不满一天的部分走 logs"""
+        for i in range(0, len(specs), 300):
+            chunk = specs[i:i + 300]
+            sql = "WITH cut (device_id, template_id, cutoff_ts) AS (VALUES " + ", ".join(["(?, ?, ?)"] * len(chunk)) + "), " \
+                  '''span AS (SELECT device_id, template_id, cutoff_ts, (cutoff_ts + 86399) / 86400 * 86400 AS day_ts FROM cut)
+                  SELECT device_id, nickname, item_type, SUM(win_times) AS win_times, SUM(win_sum) AS win_sum FROM (
+                      SELECT r.device_id, r.nickname, r.item_type, r.win_times, r.win_sum FROM span s JOIN daily_rollups r
+                          ON r.device_id = s.device_id AND r.template_id = s.template_id AND r.day >= date(s.day_ts, 'unixepoch')
+                      UNION ALL
+                      SELECT l.device_id, COALESCE(l.nickname, ''), COALESCE(l.item_type, ''), 1, COALESCE(l.quantity, 0) FROM span s JOIN logs l
+                          ON l.device_id = s.device_id AND l.template_id = s.template_id AND l.log_ts >= s.cutoff_ts AND l.log_ts < s.day_ts)
+                  GROUP BY device_id, nickname, item_type'''
+            for r in fetch_all(c, 'fleet_stats', sql, [v for spec in chunk for v in spec]):
+                self._apply(self.nodes[r['device_id']], r['nickname'], r['item_type'], r['win_times'], r['win_sum'] or 0)
+
+    def _apply(self, node, nick, item_type, times, amount):
+        u = node['users'].get(nick)
+        if u is None: u = node['users'][nick] = [0, 0]
+        u[0] += times; u[1] += amount
+        if u[0] <= 0: del node['users'][nick]
+        if item_type == '钻石': node['wins'] += amount
+        else: node['physical'] += amount
+        node['top'] = None
+
+    def refresh(self, c, rounds, floor_ts):
+        """rounds: {device_id: (template_id, round_start_ts 或 None)}；调用方已开读事务，保证各查询看到同一个快照"""
+        with self.lock:
+            seq = current_log_seq(c); horizon = archive_horizon(c)
+            # 窗口跨过归档线（保留天数 < 2）时原始行可能已不在热库，直接全量重建
+            if self.last_id is None or (horizon is not None and horizon > floor_ts): self.nodes = {}
+            elif seq != self.last_id or floor_ts != self.floor_ts:
+                if floor_ts > self.floor_ts:
+                    c.execute("SELECT device_id, template_id, nickname, item_type, quantity, log_ts FROM logs WHERE log_ts >= ? AND log_ts < ? AND id <= ?", (self.floor_ts, floor_ts, self.last_id))
+                    for r in c.fetchall():
+                        node = self.nodes.get(r['device_id'])
+                        if node and node['template_id'] == r['template_id'] and node['cutoff'] <= r['log_ts'] < max(floor_ts, node['round_ts'] or 0):
+                            self._apply(node, r['nickname'] or '', r['item_type'] or '', -1, -(r['quantity'] or 0))
+                for node in self.nodes.values(): node['cutoff'] = max(floor_ts, node['round_ts'] or 0)
+                c.execute("SELECT device_id, template_id, nickname, item_type, quantity, log_ts FROM logs WHERE id > ? AND id <= ?", (self.last_id, seq))
+                for r in c.fetchall():
+                    node = self.nodes.get(r['device_id'])
+                    if node and node['template_id'] == r['template_id'] and r['log_ts'] is not None and r['log_ts'] >= node['cutoff']:
+                        self._apply(node, r['nickname'] or '', r['item_type'] or '', 1, r['quantity'] or 0)
+            stale = []
+            for device_id in list(self.nodes):
+                if device_id not in rounds: del self.nodes[device_id]
+            for device_id, (template_id, round_ts) in rounds.items():
+                node = self.nodes.get(device_id)
+                if node and node['template_id'] == template_id and node['round_ts'] == round_ts: continue
+                cutoff = max(floor_ts, round_ts or 0)
+                self.nodes[device_id] = {"template_id": template_id, "round_ts": round_ts, "cutoff": cutoff, "users": {}, "wins": 0, "physical": 0, "top": None}
+                stale.append((device_id, template_id, cutoff))
+            if stale: self._build(c, stale)
+            self.last_id = seq; self.floor_ts = floor_ts
+
+    def summary(self, device_id, top_n):
+        with self.lock:
+            node = self.nodes.get(device_id)
+            if node is None: return None
+            if node['top'] is None or len(node['top']) < top_n:
+                node['top'] = heapq.nlargest(max(top_n, 3), node['users'].items(), key=lambda kv: kv[1][1])
+            return {"total_users": len(node['users']), "total_wins": node['wins'], "total_physical_wins": node['physical'],
+                    "top_winners": [{"nickname": k, "win_times": v[0], "win_sum": v[1]} for k, v in node['top'][:top_n]]}
+
+fleet_aggregate = FleetAggregate()
+
+def refresh_fleet(devices, now):
+    """按各节点的轮次起点 / 48 小时窗口刷新 fleet_aggregate，返回 {device_id: (round_start, cutoff datetime)}"""
+    floor = (now - timedelta(hours=48)).replace(second=0, microsecond=0)
+    conn = get_db_connection(); c = conn.cursor()
+    try:
+        round_starts = {r['round_key']: r['start_time'] for r in fetch_all(c, 'fleet_rounds', "SELECT round_key, start_time FROM round_settings")}
+        rounds = {}; round_info = {}
+        for r in devices:
+            round_start = round_starts.get(f"{r['device_id']}_{r['template_id']}", round_starts.get(r['device_id'])); round_dt = None
+            if round_start:
+                try: round_dt = datetime.strptime(round_start, '%Y-%m-%d %H:%M:%S')
+                except: pass
+            rounds[r['device_id']] = (r['template_id'], to_log_ts(round_dt)); round_info[r['device_id']] = (round_start, max(floor, round_dt) if round_dt else floor)
+        c.execute("BEGIN")  # 读事务：增量和重建查询看到同一个快照
+        fleet_aggregate.refresh(c, rounds, to_log_ts(floor))
+    finally: conn.close()
+    return round_info
+
+def warm_fleet_aggregate():
+    """web worker 启动后在后台先把 fleet_aggregate 建好（300 个节点全量构建要几百毫秒），之后的 /api/fleet_stats 只做增量"""
+    def run():
+        started = time.time()
+        try: refresh_fleet(presence.all(), datetime.now()); print(f"Fleet aggregate warmed in {time.time() - started:.2f}s", flush=True)
+        except Exception as e: print(f"Fleet Warmup Error: {e}", flush=True)
+    threading.Thread(target=run, name="fleet-warmup", daemon=True).start()
+
+@app.route('/api/details')
+def get_details():
+    """本轮明细分页（新的在前）：before_id 往前翻，after_id 取新增；limit 默认 DETAILS_PAGE_SIZE；format=columns 返回列式编码"""
+    target_node_id = request.args.get('node_id'); req_password = request.args.get('password', '')
+    if not target_node_id: return jsonify({"error": "Missing node_id"}), 400
+    before_id, after_id, limit, columnar = page_args(DETAILS_PAGE_SIZE)
+    row = presence.get(target_node_id)
+    if row and row['password'] and row['password'] != req_password: return jsonify({"error": "auth_failed"}), 403
+    template_id = row['template_id'] if row else 'default'
+    conn = get_db_connection(); c = conn.cursor()
+    try:
+        cutoff_time, _ = get_round_cutoff(c, target_node_id, template_id, datetime.now())
+        rows, has_more = query_log_page(c, 'details', target_node_id, template_id, to_log_ts(cutoff_time), None, before_id, after_id, limit)
+        return jsonify(log_page_payload("details", rows, has_more, columnar))
+    except Exception as e: return jsonify({"error": str(e)}), 500
+    finally: conn.close()
+
+@app.route('/api/fleet_stats')
+def get_fleet_stats():
+    """所有节点的状态 + 本轮统计（与 /api/stats 同样按 48 小时 / 本轮起点截断）。
+    有密码的节点需要在 passwords（JSON：{node_id: 密码}）里带上正确密码，否则只返回状态，locked = true"""
+    try: passwords = json.loads(request.args.get('passwords') or '{}')
+    except ValueError: return jsonify({"error": "bad passwords"}), 400
+    top_n = max(1, min(request.args.get('top', 3, type=int), 50))
+    now = datetime.now(); now_ts = time.time()
+    devices = sorted(presence.all(), key=lambda r: r['device_id'])
+    round_info = refresh_fleet(devices, now)
+
+    nodes = []
+    for r in devices:
+        node = {"device_id": r['device_id'], "nickname": r['nickname'], "template_id": r['template_id'], "detected_template": r['detected_template'] or "",
+                "is_online": (now_ts - (r['last_seen'] or 0)) < ONLINE_WINDOW_SECONDS, "process_running": bool(r['process_running']),
+                "process_status": device_status_text(r['last_msg'], r['last_seen'], r['process_running']), "has_password": bool(r['password'])}
+        nodes.append(node)
+        if r['password'] and passwords.get(r['device_id']) != r['password']: node['locked'] = True; continue
+        round_start, cutoff = round_info[r['device_id']]; summary = fleet_aggregate.summary(r['device_id'], top_n)
+        node.update(summary, locked=False, round_start_time=round_start, date_range=f"{cutoff.strftime('%m-%d %H:%M')} - 至今" if summary['total_users'] else "暂无数据")
+    body = app.json.dumps({"nodes": nodes, "online": sum(1 for n in nodes if n['is_online']), "total": len(nodes)})
+    return stats_response(body, hashlib.md5(body.encode('utf-8')).hexdigest())
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """从 logs 重建 daily_rollups（已归档的天数保留原汇总）：flask --app app rebuild-rollups"""
+    conn = get_db_connection(); rebuild_rollups(conn); invalidate_all_stats(conn.cursor()); conn.commit(); conn.close()
+    print("daily_rollups rebuilt", flush=True)
+
+@app.cli.command('archive-logs')
+@click.option('--retention-days', default=None, type=int, help='保留天数（默认取 LOG_RETENTION_DAYS）')
+@click.option('--vacuum/--no-vacuum', default=True, show_default=True, help='归档后整库 VACUUM 热库（期间写入会被阻塞；后台定时归档只做增量回收）')
+def archive_logs_command(retention_days, vacuum):
+    """把早于保留天数的日志按月归档并压缩热库：flask --app app archive-logs --retention-days 90"""
+    result = archive_logs(retention_days, vacuum)
+    print(json.dumps(result, ensure_ascii=False) if result else "retention disabled (set LOG_RETENTION_DAYS or --retention-days)", flush=True)
+
+@app.cli.command('ingest-workers')
+@click.option('--workers', default=INGEST_WORKERS, show_default=True, help='解析进程数')
+def ingest_workers_command(workers):
+    """运行 spool 解析进程池（INGEST_MODE=spool 时配合 web 进程使用）：flask --app app ingest-workers"""
+    # SIGTERM 转成正常退出，atexit 会一并结束 daemon 子进程
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    run_ingest_workers(workers)
+
+@app.cli.command('requeue-failed')
+def requeue_failed_command():
+    """把 spool failed/ 里的任务放回 ready/ 重新解析（重复行由 unique_sign 去重）：flask --app app requeue-failed"""
+    spool_dirs(); count = 0
+    for name in sorted(n for n in os.listdir(spool_path('failed')) if n.endswith('.json')):
+        job = name[:-len('.json')]
+        if os.path.exists(spool_path('failed', job + '.dat')): os.replace(spool_path('failed', job + '.dat'), spool_path('ready', job + '.dat'))
+        os.replace(spool_path('failed', name), spool_path('ready', name)); count += 1
+    print(f"requeued {count} failed spool jobs", flush=True)
 
 if __name__ == '__main__':
+    if INGEST_MODE == 'spool': threading.Thread(target=run_ingest_workers, name="ingest-supervisor", daemon=True).start()
+    warm_fleet_aggregate()
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
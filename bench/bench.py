@@ -0,0 +1,192 @@
+"""入库与查询接口压测：用 Flask test client 打 /upload、/api/stats、/api/user_total、/api/history_logs。
+
+数据库按 --scales 逐级灌数（默认 10k → 1m → 10m 行），每一级记录：
+  - 各模板 /upload 的入库速度（行/秒）
+  - 各接口延迟的 p50 / p99（毫秒）
+结果写成 JSON；带 --baseline 时和旧结果对比，超出 --tolerance 的退化会列出来并以非 0 退出。
+
+    python bench/bench.py --scales 10k,1m --out bench/baseline.json
+    python bench/bench.py --scales 10k,1m --baseline bench/baseline.json --out /tmp/now.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from loggen import TEMPLATES, FILE_NAMES, generate_lines
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_NODE = 'bench-node'
+SEED_BATCH = 50000
+
+def parse_scale(text):
+    text = text.strip().lower()
+    for suffix, mul in (('k', 1000), ('m', 1000000)):
+        if text.endswith(suffix): return int(float(text[:-1]) * mul)
+    return int(text)
+
+def load_app(workdir):
+    """用独立的数据目录导入 app（DB_PATH 等在 import 时读取，必须先设环境变量）"""
+    os.environ.update(DB_PATH=os.path.join(workdir, 'lottery.db'), ROUND_SETTINGS_FILE=os.path.join(workdir, 'round_settings.json'),
+                      SPOOL_DIR=os.path.join(workdir, 'spool'), METRICS_DIR=os.path.join(workdir, 'metrics'), INGEST_MODE='inline')
+    sys.path.insert(0, ROOT)
+    import app
+    return app
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def summarize(samples):
+    return {"n": len(samples), "p50": round(percentile(samples, 0.5), 3), "p99": round(percentile(samples, 0.99), 3),
+            "mean": round(sum(samples) / len(samples), 3)}
+
+def timed(fn, repeat, before=None):
+    samples = []
+    for i in range(repeat):
+        if before: before(i)
+        started = time.perf_counter(); fn(i); samples.append((time.perf_counter() - started) * 1000)
+    return summarize(samples)
+
+def upload(client, device_id, template_id, payload, file_name):
+    r = client.post('/upload', content_type='multipart/form-data',
+                    data={'device_id': device_id, 'nickname': 'bench', 'process_running': 'True', 'template_id': template_id, 'file': (io.BytesIO(payload), file_name)})
+    assert r.status_code == 200, r.get_data(as_text=True)
+    return r.get_json()
+
+def seed_rows(app, device_id, template_id, count, end, days, seed):
+    """直接走模板解析 + insert_log_batch 批量灌数（不经过 HTTP），返回实际插入行数"""
+    conn = app.get_db_connection(); c = conn.cursor(); batch = []; inserted = 0; tpl = app.get_template(template_id)
+    for line in generate_lines(template_id, count, end=end, days=days, date_style='mixed', seed=seed):
+        log_time, nick, item_type, quantity = tpl.parse(line)
+        batch.append((log_time, nick, item_type, quantity, f"{log_time}_{nick}_{item_type}_{quantity}_{device_id}", device_id, template_id, tpl.converter(log_time)(log_time)))
+        if len(batch) >= SEED_BATCH: inserted += app.insert_log_batch(c, batch); conn.commit(); batch = []
+    if batch: inserted += app.insert_log_batch(c, batch)
+    app.invalidate_stats(c, device_id); conn.commit(); conn.close()
+    return inserted
+
+def check_utf8_upload(app, client):
+    """回归检查：超过一个读取块的 utf-8 文件，第一个 gb18030 解不了的字节在第一块之后，整份也必须按 utf-8 入库"""
+    device_id = 'check-utf8'; lines = list(generate_lines('default', 1500, seed=3)) + ['[2024-01-01 00:00:00] 玩家耀_123456 | 抽奖,恭喜获得,7']
+    payload = '\n'.join(lines).encode('utf-8') + b'\n'
+    assert len(payload) > app.UPLOAD_CHUNK_SIZE
+    upload(client, device_id, 'default', payload, 'lot.txt')
+    c = app.get_db_connection()
+    bad = c.execute("SELECT COUNT(*) FROM logs WHERE device_id = ? AND nickname NOT LIKE '玩家%'", (device_id,)).fetchone()[0]
+    total = c.execute("SELECT COUNT(*) FROM logs WHERE device_id = ?", (device_id,)).fetchone()[0]; c.close()
+    assert bad == 0 and total > 0, f"utf-8 upload decoded as gb18030: {bad} of {total} rows garbled"
+    print(f"utf-8 upload check: {total} rows ok", flush=True)
+
+def bench_ingest(app, client, scale_label, lines, days):
+    """每个模板用一个新设备上传一份完整文件，测整条 /upload 路径的吞吐"""
+    results = {}
+    for template_id in TEMPLATES:
+        payload = '\n'.join(generate_lines(template_id, lines, days=days, date_style='mixed', seed=lines)).encode('gb18030') + b'\n'
+        device_id = f"ingest-{scale_label}-{template_id}"
+        client.post('/api/set_template', json={'node_id': device_id, 'template_id': template_id})
+        started = time.perf_counter()
+        body = upload(client, device_id, template_id, payload, FILE_NAMES[template_id].format(day='20240101'))
+        elapsed = time.perf_counter() - started
+        results[template_id] = {"lines": lines, "bytes": len(payload), "inserted": body['new_entries'], "seconds": round(elapsed, 3),
+                                "lines_per_sec": int(lines / elapsed) if elapsed > 0 else 0}
+    return results
+
+def bench_endpoints(app, client, repeat, end, days):
+    c = app.get_db_connection(); cur = c.cursor()
+    cur.execute("SELECT nickname FROM daily_rollups WHERE device_id = ? GROUP BY nickname ORDER BY SUM(win_times) DESC LIMIT 1", (BENCH_NODE,))
+    top_nick = cur.fetchone()['nickname']; c.close()
+    mid_day = (end - timedelta(days=days // 2)).strftime('%Y-%m-%d')
+    range_args = f"start_date={(end - timedelta(days=days)).strftime('%Y-%m-%dT%H:%M')}&end_date={end.strftime('%Y-%m-%dT%H:%M')}"
+
+    def get(url):
+        r = client.get(url); assert r.status_code == 200, (url, r.status_code); return r
+
+    def small_upload(i):
+        # 每次 100 行新数据（时间往后推，避免被去重），走和客户端增量上传一样的小包路径
+        payload = '\n'.join(generate_lines('default', 100, end=end + timedelta(hours=i + 1), days=1 / 24, seed=i)).encode('gb18030') + b'\n'
+        upload(client, BENCH_NODE, 'default', payload, 'lot.txt')
+
+    return {
+        "upload_100_lines": timed(small_upload, repeat),
+        "stats": timed(lambda i: get(f'/api/stats?node_id={BENCH_NODE}'), repeat, before=lambda i: app.stats_cache.clear()),
+        "stats_cached": timed(lambda i: get(f'/api/stats?node_id={BENCH_NODE}'), repeat),
+        "user_total_all": timed(lambda i: get(f'/api/user_total?node_id={BENCH_NODE}&calc_all=1&{range_args}'), repeat),
+        "user_total_nickname": timed(lambda i: get(f'/api/user_total?node_id={BENCH_NODE}&nickname={top_nick}&{range_args}'), repeat),
+        "user_total_users": timed(lambda i: get(f'/api/user_total?node_id={BENCH_NODE}'), repeat),
+        "history_logs": timed(lambda i: get(f'/api/history_logs?node_id={BENCH_NODE}&date={mid_day}'), repeat),
+    }
+
+def compare(baseline, current, tolerance):
+    """返回退化列表：延迟比基线高 tolerance 以上、或入库速度低 tolerance 以上"""
+    regressions = []
+    for scale, cur in current['scales'].items():
+        base = baseline.get('scales', {}).get(scale)
+        if not base: continue
+        for name, stats in cur['latency_ms'].items():
+            old = base['latency_ms'].get(name)
+            if not old: continue
+            for key in ('p50', 'p99'):
+                if old[key] > 0 and stats[key] > old[key] * (1 + tolerance):
+                    regressions.append(f"{scale} {name} {key}: {old[key]:.2f}ms -> {stats[key]:.2f}ms")
+        for template_id, stats in cur['ingest'].items():
+            old = base['ingest'].get(template_id)
+            if old and stats['lines_per_sec'] < old['lines_per_sec'] * (1 - tolerance):
+                regressions.append(f"{scale} ingest {template_id}: {old['lines_per_sec']} -> {stats['lines_per_sec']} lines/s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='lot-monitor 入库/查询压测')
+    parser.add_argument('--scales', default='10k,1m,10m', help='逐级灌到的总行数，逗号分隔，支持 k/m 后缀')
+    parser.add_argument('--days', type=int, default=60, help='灌入数据覆盖的天数')
+    parser.add_argument('--ingest-lines', type=int, default=20000, help='每个模板 /upload 入库测试的行数')
+    parser.add_argument('--repeat', type=int, default=50, help='每个接口的请求次数')
+    parser.add_argument('--workdir', default=None, help='数据库目录（默认临时目录，结束后删除）')
+    parser.add_argument('--out', default=None, help='结果 JSON 路径')
+    parser.add_argument('--baseline', default=None, help='对比用的旧结果 JSON')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='lot-bench-')
+    app = load_app(workdir); client = app.app.test_client()
+    end = datetime.now().replace(microsecond=0)
+    client.post('/api/heartbeat', json={'device_id': BENCH_NODE, 'nickname': 'bench', 'process_running': True})
+    app.presence.flush()
+    check_utf8_upload(app, client)
+    results = {"meta": {"created_at": end.strftime('%Y-%m-%d %H:%M:%S'), "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                        "platform": platform.platform(), "days": args.days, "ingest_lines": args.ingest_lines, "repeat": args.repeat}, "scales": {}}
+    total = 0
+    try:
+        for label in [s.strip() for s in args.scales.split(',') if s.strip()]:
+            target = parse_scale(label)
+            started = time.perf_counter()
+            if target > total: total += seed_rows(app, BENCH_NODE, 'default', target - total, end, args.days, seed=target)
+            seed_seconds = time.perf_counter() - started
+            print(f"[{label}] seeded {total} rows in {seed_seconds:.1f}s", flush=True)
+            scale = {"rows": total, "seed_seconds": round(seed_seconds, 3), "db_bytes": os.path.getsize(app.DB_PATH),
+                     "ingest": bench_ingest(app, client, label, args.ingest_lines, args.days),
+                     "latency_ms": bench_endpoints(app, client, args.repeat, end, args.days)}
+            results['scales'][label] = scale
+            for template_id, r in scale['ingest'].items(): print(f"[{label}] ingest {template_id}: {r['lines_per_sec']} lines/s", flush=True)
+            for name, r in scale['latency_ms'].items(): print(f"[{label}] {name}: p50 {r['p50']:.2f}ms  p99 {r['p99']:.2f}ms", flush=True)
+    finally:
+        if not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f: json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"results -> {args.out}", flush=True)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f: regressions = compare(json.load(f), results, args.tolerance)
+        for line in regressions: print(f"REGRESSION {line}", flush=True)
+        if regressions: sys.exit(1)
+        print("no regressions against baseline", flush=True)
+
+if __name__ == '__main__':
+    main()
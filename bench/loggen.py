@@ -0,0 +1,73 @@
+"""按 LOG_PARSERS 的三种格式生成模拟日志，供压测和本地调试使用。
+
+    python bench/loggen.py --template pixiu --lines 100000 --out /tmp/logs
+    python bench/loggen.py --template all --lines 10000 --date-style mixed --out /tmp/logs
+"""
+import os
+import random
+import argparse
+from datetime import datetime, timedelta
+
+TEMPLATES = ('default', 'qilin', 'pixiu')
+# parse_log_date 支持的四种日期写法（貔貅固定用 年月日时分秒，入库前由解析器转成 '-' 格式）
+DATE_STYLES = {
+    'iso': lambda dt: dt.strftime('%Y-%m-%d %H:%M:%S'),
+    'slash': lambda dt: dt.strftime('%Y/%m/%d %H:%M:%S'),
+    'dot': lambda dt: dt.strftime('%Y.%m.%d %H:%M:%S'),
+    'apache': lambda dt: f"{dt.day:02d}/{dt.strftime('%b')}/{dt.year} {dt.strftime('%H:%M:%S')}",
+}
+FILE_NAMES = {'default': 'lot.txt', 'qilin': '{day}qiling.txt', 'pixiu': '{day}中奖记录.txt'}
+PHYSICAL_ITEMS = ['手机', '耳机', '充电宝', '口红', '保温杯', '蓝牙音箱']
+
+def format_time(dt, template_id, style):
+    if template_id == 'pixiu': return dt.strftime('%Y年%m月%d日 %H时%M分%S秒')
+    return DATE_STYLES[style](dt)
+
+def format_line(template_id, dt, nick, quantity, style='iso', rng=random):
+    if template_id == 'qilin': return f"[{format_time(dt, template_id, style)}] 恭喜[{nick}]在幸运抽奖中了-{quantity}-钻石"
+    if template_id == 'pixiu':
+        # 大约 15% 是实物奖品，其余是“x钻”
+        prize = rng.choice(PHYSICAL_ITEMS) if rng.random() < 0.15 else f"{quantity}钻"
+        return f"{format_time(dt, template_id, style)}----{rng.randint(10000, 99999)}----房间{rng.randint(1, 50)}----{nick}----{prize}"
+    return f"[{format_time(dt, template_id, style)}] {nick}_{rng.randint(100000, 999999)} | 抽奖,恭喜获得,{quantity}"
+
+def generate_lines(template_id, count, end=None, days=30, users=500, date_style='iso', seed=None):
+    """按时间顺序产出 count 行日志，均匀分布在 end 之前 days 天内；date_style='mixed' 时四种日期写法轮流出现"""
+    rng = random.Random(seed)
+    end = (end or datetime.now()).replace(microsecond=0)
+    start = end - timedelta(days=days)
+    step = days * 86400 / max(count, 1)
+    nicks = [f"玩家{i:04d}" for i in range(users)]
+    styles = list(DATE_STYLES) if date_style == 'mixed' else [date_style]
+    for i in range(count):
+        dt = start + timedelta(seconds=int(i * step))
+        # 少数大户贡献大部分中奖，贴近真实分布
+        nick = nicks[min(int(rng.paretovariate(1.2)) - 1, users - 1)] if rng.random() < 0.3 else rng.choice(nicks)
+        quantity = rng.choice((1, 2, 5, 10, 20, 50, 100, 200, 520, 1314))
+        yield format_line(template_id, dt, nick, quantity, styles[i % len(styles)], rng)
+
+def write_log_file(path, lines, encoding='gb18030'):
+    with open(path, 'w', encoding=encoding, newline='\n') as f:
+        for line in lines: f.write(line + '\n')
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description='生成模拟中奖日志')
+    parser.add_argument('--template', default='all', choices=TEMPLATES + ('all',))
+    parser.add_argument('--lines', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--date-style', default='iso', choices=tuple(DATE_STYLES) + ('mixed',))
+    parser.add_argument('--encoding', default='gb18030')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--out', default='.')
+    args = parser.parse_args()
+    os.makedirs(args.out, exist_ok=True)
+    for template_id in (TEMPLATES if args.template == 'all' else (args.template,)):
+        name = FILE_NAMES[template_id].format(day=datetime.now().strftime('%Y%m%d'))
+        path = write_log_file(os.path.join(args.out, name),
+                              generate_lines(template_id, args.lines, days=args.days, users=args.users, date_style=args.date_style, seed=args.seed), args.encoding)
+        print(f"{template_id}: {args.lines} lines -> {path}", flush=True)
+
+if __name__ == '__main__':
+    main()
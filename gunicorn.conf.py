@@ -0,0 +1,24 @@
+# gunicorn 启动时自动读取当前目录下的 gunicorn.conf.py（镜像的 CMD 在 /app 下运行）
+# INGEST_MODE=spool 时由 master 拉起 spool 解析进程池（flask --app app ingest-workers），gunicorn 退出时一起停掉；
+# 每个 worker 启动后在后台预建 /api/fleet_stats 的聚合，第一个请求不用等全量构建
+import os
+import sys
+import subprocess
+
+ingest_supervisor = None
+
+def when_ready(server):
+    global ingest_supervisor
+    if os.environ.get('INGEST_MODE', 'inline') != 'spool': return
+    ingest_supervisor = subprocess.Popen([sys.executable, '-m', 'flask', '--app', 'app', 'ingest-workers'])
+    server.log.info("Started spool ingest workers (pid %s)", ingest_supervisor.pid)
+
+def on_exit(server):
+    if ingest_supervisor is None or ingest_supervisor.poll() is not None: return
+    ingest_supervisor.terminate()
+    try: ingest_supervisor.wait(10)
+    except subprocess.TimeoutExpired: ingest_supervisor.kill()
+
+def post_worker_init(worker):
+    import app
+    app.warm_fleet_aggregate()